@@ -0,0 +1,8 @@
+
+import os
+
+
+def write_note(zkdir, note_id, tags="", body=""):
+    date = f"20{note_id[0:2]}-{note_id[2:4]}-{note_id[4:6]} {note_id[6:8]}:{note_id[8:10]}:{note_id[10:12]}"
+    with open(os.path.join(zkdir, f"zk{note_id}.md"), "w") as fd:
+        fd.write(f"<!-- ZK{note_id} -->\n---\nDate: {date}\nID: {note_id}\nTags: {tags}\n---\n{body}")
@@ -0,0 +1,164 @@
+
+import re
+import random
+import pytest
+import zk2
+from zk2 import index as zkindex
+
+from conftest import write_note
+
+# The original query syntax, [tag]*["string with spaces]?[@123456789012]?
+re_legacy_query = re.compile(r'([^"@]+)*("[^@]+)?(@\d+)?')
+
+TAGS = ["diy", "DIY-tools", "wood", "woodworking", "workshop", "python", "archived", "Zk"]
+
+
+@pytest.fixture(scope="module")
+def zk(tmp_path_factory):
+    zkdir = tmp_path_factory.mktemp("notes")
+    rnd = random.Random(1)
+    for i in range(200):
+        tags = " ".join(rnd.sample(TAGS, rnd.randint(0, 3)))
+        words = " ".join(rnd.choice(["wood-working", "bench", "brilliant", "zk", "plane"]) for _ in range(10))
+        write_note(zkdir, f"1901{i // 24 + 10:02d}{i % 24:02d}0000", tags, words)
+    return zk2.ZK(str(zkdir), use_cache=False, search_index=True)
+
+
+class TestIndex:
+
+    def reference_filter(self, zk, tags):
+        # The plain scan that the tag index replaces
+        if not tags:
+            return [n for n in zk._notes if "archived" not in n.tags]
+        if tags == ["untagged"]:
+            return [n for n in zk._notes if not n.tags]
+        return [
+            n for n in zk._notes
+            if ("archived" not in n.tags or "archived" in tags)
+            and all(any(t.lower().startswith(q.lower()) for t in n.tags) for q in tags)
+        ]
+
+    @pytest.mark.parametrize("tags", [None, ["untagged"], ["diy"], ["wood", "diy"], ["Wo"], ["archived"], ["archived", "zk"], ["nope"], [""]])
+    def test_filter(self, zk, tags):
+        assert {n.id for n in zk._filter(tags)} == {n.id for n in self.reference_filter(zk, tags)}
+
+    def test_tags(self, zk):
+        counts = {}
+        for n in zk._notes:
+            if "archived" not in n.tags:
+                for t in n.tags:
+                    counts[t] = counts.get(t, 0) + 1
+        assert zk.tags(mincount=1) == sorted(counts)
+        assert zk.tags(mincount=30) == sorted(t for t, c in counts.items() if c >= 30)
+
+    @pytest.mark.parametrize("query", ["wood-working", "BRILLIANT", "bench plane", "pl.ne", "b[er]nch", "zk|nope", "plane$", "xyz"])
+    def test_search(self, zk, query):
+        plain = zk2.ZK(zk.zkdir, use_cache=False, search_index=False)
+        assert {n.id for n in zk._search(query)} == {n.id for n in plain._search(query)}
+
+    def test_text_index_updates(self, monkeypatch):
+        monkeypatch.setattr(zkindex, "COMPACT_MIN", 0)
+        index = zkindex.TextIndex()
+        for i, body in enumerate(["bench plane", "plane", "Brilliant BENCH", "zk"]):
+            index.add(i, zk2.ZKNote(data={"date": None, "modified": None, "id": str(i), "author": "",
+                                          "tags": [], "title": "", "body": body}))
+        assert index.candidates("bench") == {0, 2}
+        index.remove(0)
+        index.remove(3)
+        assert index.candidates("bench") == {2}
+        # Compacted, more removed than left
+        index.remove(1)
+        assert index.candidates("plane") == set()
+        assert index.candidates("bench") == {2}
+        assert index.candidates(".*") is None
+
+    def test_text_index_unreadable(self, tmp_path):
+        index = zkindex.TextIndex()
+        for note_id in ["190101120000", "190102120000", "190103120000"]:
+            write_note(tmp_path, note_id, "", "Workbench")
+            index.add(note_id, zk2.ZKNote(str(tmp_path / f"zk{note_id}.md"), header_only=True))
+        # Lazy bodies of files removed or broken since
+        (tmp_path / "zk190102120000.md").unlink()
+        (tmp_path / "zk190103120000.md").write_text("No header")
+        assert index.candidates("bench") == {"190101120000"}
+        assert index.take_unreadable() == {"190102120000", "190103120000"}
+        assert index.take_unreadable() == set()
+        # Each note is indexed once
+        assert list(index._postings[zkindex.trigrams("ben").pop()]) == [0]
+        write_note(tmp_path, "190102120000", "", "Workbench")
+        index.add("190102120000", zk2.ZKNote(str(tmp_path / "zk190102120000.md"), header_only=True))
+        assert index.candidates("bench") == {"190101120000", "190102120000"}
+
+    @pytest.mark.parametrize("query", ["", "diy", "wo diy", "untagged", "archived", '"bench', 'diy "pl.ne', "@19011", 'wood "brilliant @1901', '"zk @190112', "@2", "nope @1901"])
+    def test_execute_query(self, zk, query):
+        plain = zk2.ZK(zk.zkdir, use_cache=False, search_index=False)
+        m = re_legacy_query.match(query)
+        tags = m.group(1).rstrip().split(' ') if m.group(1) else None
+        notes = set(plain._filter(tags))
+        if m.group(2):
+            notes &= set(plain._search(m.group(2).strip('"').strip(' ')))
+        if m.group(3):
+            notes &= set(plain.id_match(m.group(3).lstrip('@')))
+        assert {n.id for n in zk.execute_query(query)} == {n.id for n in notes}
+
+    @pytest.mark.parametrize("key", ["date", "modified", "title"])
+    @pytest.mark.parametrize("reverse", [True, False])
+    def test_query_page(self, zk, key, reverse):
+        everything = zk.query("diy", sort_key=key, reverse=reverse)
+        zk._memo.clear()
+        total, page = zk.query_page("diy", sort_key=key, reverse=reverse, offset=10, limit=15)
+        assert total == len(everything)
+        assert [n["id"] for n in page] == [n["id"] for n in everything[10:25]]
+
+    @pytest.mark.parametrize("key", ["date", "modified", "title", "bogus"])
+    @pytest.mark.parametrize("limit", [None, 7])
+    def test_presorted(self, zk, monkeypatch, key, limit):
+        monkeypatch.setattr(zk2.ZKDatabase, "SORT_WALK_RATIO", 10**6)
+        walked = zk.query_page("wo", sort_key=key, offset=3, limit=limit)
+        zk._memo.clear()
+        monkeypatch.setattr(zk2.ZKDatabase, "SORT_WALK_RATIO", 0)
+        sorted_ = zk.query_page("wo", sort_key=key, offset=3, limit=limit)
+        assert walked == sorted_
+
+    @pytest.mark.parametrize("query, expected", [
+        ("diy OR wood", lambda n: not n.archived and (n.has("diy") or n.has("wood"))),
+        ("-diy", lambda n: not n.archived and not n.has("diy")),
+        ("NOT diy wood", lambda n: not n.archived and not n.has("diy") and n.has("wood")),
+        ("(diy OR python) -wood", lambda n: not n.archived and (n.has("diy") or n.has("python")) and not n.has("wood")),
+        ("archived OR zk", lambda n: n.has("archived") or n.has("zk")),
+        ("date:2019-01-12", lambda n: not n.archived and n.id.startswith("190112")),
+        ("date:2019-01-12..2019-01-13 diy", lambda n: not n.archived and n.id[:6] in ("190112", "190113") and n.has("diy")),
+        ("date:>=2019-01-17", lambda n: not n.archived and n.id >= "190117"),
+        ("date:<2019-01-11", lambda n: not n.archived and n.id < "190111"),
+        ("date:19x", lambda n: False),
+        ('"bench plane" OR "brilliant zk"', lambda n: not n.archived and ("bench plane" in n.body or "brilliant zk" in n.body)),
+        ('-"plane"', lambda n: not n.archived and "plane" not in n.body),
+        ('text:bench title:^plane', lambda n: not n.archived and "bench" in n.body and n.title.startswith("plane")),
+        ('"pl(ne', lambda n: False),
+        ("untagged OR tag:zk", lambda n: not n.archived and (not n.tags or n.has("zk"))),
+        ("id:19011 OR @19012", lambda n: not n.archived and n.id.startswith(("19011", "19012"))),
+        ("(diy OR", lambda n: not n.archived and n.has("diy")),
+        ("diy) wood", lambda n: not n.archived and n.has("diy") and n.has("wood")),
+    ])
+    def test_query_syntax(self, zk, query, expected):
+        class Note:
+            def __init__(self, note):
+                self.id, self.tags, self.body, self.title = note.id, note.tags, note.body, note.title
+                self.archived = "archived" in note.tags
+
+            def has(self, prefix):
+                return any(t.lower().startswith(prefix) for t in self.tags)
+        assert {n.id for n in zk.execute_query(query)} == {n.id for n in zk._notes if expected(Note(n))}
+        assert zk2.query.parse_query(query) is zk2.query.parse_query(query)
+
+    def test_memo(self, zk):
+        first = zk.query_page("wood", offset=0, limit=5)
+        hits = zk._memo.hits
+        assert zk.query_page("wood", offset=0, limit=5) == first
+        assert zk.query_page("wood", offset=5, limit=5)[1] == zk.query("wood")[5:10]
+        assert zk._memo.hits > hits
+        generation = zk.generation
+        zk.rename_tag("woodworking", "carpentry")
+        assert zk.generation > generation
+        assert all("woodworking" not in n["tags"] for n in zk.query("wood"))
+        zk.rename_tag("carpentry", "woodworking")
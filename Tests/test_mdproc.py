@@ -0,0 +1,104 @@
+import io
+import os
+import sys
+import pytest
+
+# zk2.server needs Flask
+pytest.importorskip("flask")
+
+from zk2.server import mdproc, mdworker
+
+
+def test_render_cache_eviction():
+    cache = mdproc.RenderCache(10)
+    cache.put(("1", b"a"), "1234")
+    cache.put(("2", b"a"), "1234")
+    assert cache.get(("1", b"a")) == "1234"
+    # Over max_size, the least recently used entry goes
+    cache.put(("3", b"a"), "1234")
+    assert cache.get(("2", b"a")) is None
+    assert cache.get(("1", b"a")) == "1234"
+    assert cache.size == 8
+    # Replacing an entry doesn't count twice
+    cache.put(("3", b"a"), "123456")
+    assert cache.stats()["entries"] == 2 and cache.size == 10
+    # Too large to cache at all
+    cache.put(("4", b"a"), "x" * 11)
+    assert cache.get(("4", b"a")) is None
+    assert cache.size == 10
+
+
+def test_render_cache_invalidate():
+    cache = mdproc.RenderCache(1024)
+    cache.put(("1", b"a"), "old")
+    cache.put(("1", b"b"), "new")
+    cache.put(("2", b"a"), "other")
+    cache.invalidate({"1"})
+    assert cache.get(("1", b"a")) is None and cache.get(("1", b"b")) is None
+    assert cache.get(("2", b"a")) == "other"
+    assert cache.size == len("other")
+
+
+def test_render_uses_cache(monkeypatch):
+    monkeypatch.setattr(mdproc, "cache", mdproc.RenderCache(1024))
+    calls = []
+    renderer = mdproc.Renderer("")
+    monkeypatch.setattr(renderer, "process", lambda text: calls.append(text) or f"<p>{text}</p>")
+    monkeypatch.setattr(mdproc, "renderer", lambda: renderer)
+    assert mdproc.render("text", note_id="1") == "<p>text</p>"
+    assert mdproc.render("text", note_id="1") == "<p>text</p>"
+    assert calls == ["text"]
+    # A changed note is a new key
+    mdproc.render("edited", note_id="1")
+    mdproc.cache.invalidate(["1"])
+    mdproc.render("text", note_id="1")
+    assert calls == ["text", "edited", "text"]
+
+
+def test_worker_framing():
+    infile = io.BytesIO(b"3\n<b>" + b"4\nfail" + b"2\n\xc3\xa5")
+    outfile = io.BytesIO()
+
+    def render(text):
+        if text == "fail":
+            raise ValueError(text)
+        return text.upper()
+
+    mdworker.serve(render, infile, outfile)
+    assert outfile.getvalue() == b"3\n<B>" + b"-1\n" + b"2\n\xc3\x85"
+
+
+def test_pool_renderer(monkeypatch):
+    # The workers import zk2 like the tests do
+    monkeypatch.setenv("PYTHONPATH", os.pathsep.join(sys.path))
+    pool = mdproc.make_renderer(f"pool:{sys.executable} -m zk2.server.mdworker html:escape")
+    try:
+        assert isinstance(pool, mdproc.PoolRenderer)
+        assert pool.process("<b>ä & ö</b>") == "&lt;b&gt;ä &amp; ö&lt;/b&gt;"
+        # The worker is kept for the next render
+        proc = pool._idle.queue[0]
+        assert pool.process("") == ""
+        assert pool._idle.queue == [proc]
+        # and restarted if it died
+        proc.kill()
+        proc.wait()
+        assert pool.process("a < b") == "a &lt; b"
+        assert pool._idle.queue[0] is not proc
+    finally:
+        pool.close()
+
+
+def test_pool_renderer_fallback():
+    pool = mdproc.PoolRenderer("/nonexistent/renderer", 1)
+    assert pool.process("text") == pool._default_process("text")
+
+
+def test_pool_renderer_timeout():
+    pool = mdproc.PoolRenderer(f"{sys.executable} -c 'import time; time.sleep(60)'", 1, timeout=0.2)
+    try:
+        assert pool.process("text") == pool._default_process("text")
+        # The hung worker was killed, its slot is free again
+        assert pool._idle.empty()
+        assert pool.process("text") == pool._default_process("text")
+    finally:
+        pool.close()
@@ -0,0 +1,44 @@
+
+import pytest
+import zk2
+from zk2 import metrics
+
+from conftest import write_note
+
+
+@pytest.fixture
+def enabled():
+    metrics.reset()
+    metrics.enable()
+    yield
+    metrics.enable(False)
+    metrics.reset()
+
+
+def test_disabled():
+    metrics.reset()
+    metrics.start_trace()
+    with metrics.timer("scan"):
+        metrics.count("notes_scanned")
+    assert metrics.end_trace() is None
+    assert "scan" not in metrics.render()
+
+
+def test_stages(tmp_path, enabled):
+    write_note(tmp_path, "190101120000", "diy", "First note")
+    write_note(tmp_path, "190102120000", "diy", "Second note")
+    zk = zk2.ZK(str(tmp_path), use_cache=False)
+    metrics.start_trace()
+    write_note(tmp_path, "190103120000", "diy", "Third note")
+    zk.rebuild_db()
+    zk.query_page("diy", limit=1)
+    trace = metrics.end_trace()
+    assert {"scan", "parse", "apply", "query", "sort"} <= set(trace.timings)
+    assert trace.counters == {"notes_scanned": 3, "cache_hits": 0, "notes_parsed": 1, "query_matches": 3}
+    header = trace.server_timing()
+    assert 'notes_parsed;desc="1"' in header and "total;dur=" in header
+    text = metrics.render()
+    # Initial load (2 files) and rebuild (3 files)
+    assert 'zk2_stage_seconds_count{stage="parse"} 2' in text
+    assert 'zk2_stage_seconds_bucket{stage="query",le="+Inf"} 1' in text
+    assert "zk2_notes_scanned_total 5" in text
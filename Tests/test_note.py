@@ -0,0 +1,112 @@
+
+import random
+import pytest
+import zk2
+from zk2 import definitions as defs
+from zk2.ZKNote import ZKNote, MalformedNote, re_header_entry
+
+HEADER = "Date: 2019-01-01 12:00:00\nID: 190101120000\n"
+
+NOTES = {
+    "plain": f"<!-- ZK190101120000 -->\n---\n{HEADER}Tags: diy, wood\nTitle: A note\n---\nBody text\n",
+    "crlf": f"<!-- ZK -->\r\n---\r\n{HEADER}Tags: a b\r\n---\r\nLine 1\r\nLine 2\r\n".replace("\n", "\r\n").replace("\r\r", "\r"),
+    "cr": f"---\r{HEADER}---\rLine 1\rLine 2".replace("\n", "\r"),
+    "junk_before": f"junk\n\n-- -\n---\n{HEADER}---\n\nBody\n",
+    "spaced_delimiters": f"  ---\t\n{HEADER} ---  \nBody\n",
+    "odd_keys": f"---\n{HEADER}Date : 2020-01-01\nX-Tags: nope\n1d: nope\nTAGS:   x,y  z  \nTitle:\nAuthor:Someone:else\n  Modified: 2019-02-01T10:00:00  \nbroken line\n\n---\nBody\n",
+    "no_newline_after_header": f"---\n{HEADER}---",
+    "dashes_in_body": f"---\n{HEADER}---\nBody\n---\nMore\n---\n",
+    "unicode": f"---\n{HEADER}Title: Ünïcödé ✓\n---\nБоди 😀\n",
+    "derived_title": f"---\n{HEADER}---\n" + "word " * 5000,
+    "long_with_title": f"---\n{HEADER}Title: Long\n---\n" + "word " * 5000,
+    "long_header": f"---\n{HEADER}Title: \n" + "Comment: x\n" * 3000 + "---\n" + "body " * 10,
+}
+
+MALFORMED = {
+    "no_header": "Just text\nno header\n",
+    "unterminated": f"---\n{HEADER}Body\n",
+    "empty": "",
+    "bad_date": "---\nDate: yesterday\n---\n",
+}
+
+
+def reference(notepath):
+    # The original line by line parser
+    note = ZKNote.__new__(ZKNote)
+    for key in defs.HEADER_KEYS:
+        setattr(note, key, None)
+    note.backlinks = []
+    note._path = notepath
+    with open(notepath, "r", encoding="utf-8") as fd:
+        line = ""
+        while line != "---":
+            line = fd.readline()
+            if not line:
+                return None
+            line = line.strip()
+        while True:
+            line = fd.readline()
+            if not line:
+                return None
+            line = line.strip()
+            if line == "---":
+                break
+            match = re_header_entry.match(line)
+            if match:
+                note.parse_entry(key=match.group(1), value=match.group(2))
+        note._body = fd.read()
+    note.validate()
+    return note
+
+
+def write(tmp_path, name, text):
+    notepath = tmp_path / f"zk{name}.md"
+    notepath.write_bytes(text.encode("utf-8"))
+    return str(notepath)
+
+
+@pytest.mark.parametrize("name", sorted(NOTES))
+def test_same_as_reference(tmp_path, name):
+    notepath = write(tmp_path, name, NOTES[name])
+    expected = reference(notepath)._asdict()
+    assert ZKNote(notepath)._asdict() == expected
+    header_only = ZKNote(notepath, header_only=True)
+    assert header_only._body is None
+    assert header_only._asdict() == expected
+
+
+def test_empty_header(tmp_path):
+    note = ZKNote(write(tmp_path, "empty", "---\n---\nJust a body\n"))
+    assert (note.body, note.title, note.tags) == ("Just a body\n", "Just a body\n", [])
+
+
+@pytest.mark.parametrize("name", sorted(MALFORMED))
+def test_malformed(tmp_path, name):
+    notepath = write(tmp_path, name, MALFORMED[name])
+    with pytest.raises(ValueError):
+        ZKNote(notepath)
+    with open(notepath) as fd:
+        with pytest.raises(ValueError):
+            ZKNote().parse(fd)
+
+
+def test_malformed_files_are_skipped(tmp_path):
+    write(tmp_path, "190101120000", NOTES["plain"])
+    write(tmp_path, "190102120000", MALFORMED["unterminated"])
+    zk = zk2.ZK(str(tmp_path), use_cache=False)
+    assert [n.id for n in zk._notes] == ["190101120000"]
+
+
+def test_random_notes(tmp_path):
+    rnd = random.Random(2)
+    chars = "ab :-\t\n\r, é"
+    for i in range(200):
+        text = "".join(rnd.choice(chars) for _ in range(rnd.randint(0, 40)))
+        text = text.replace("-", "---", rnd.randint(0, 3))
+        notepath = write(tmp_path, str(i), "---\n" + HEADER + text + "\n---\n" + text)
+        expected = reference(notepath)
+        if expected is None:
+            with pytest.raises(MalformedNote):
+                ZKNote(notepath)
+        else:
+            assert ZKNote(notepath)._asdict() == expected._asdict()
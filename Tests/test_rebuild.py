@@ -0,0 +1,317 @@
+
+import os
+import time
+import threading
+import pytest
+import zk2
+
+from zk2 import zk_tool
+from zk2.ZKNote import note_path
+from conftest import write_note
+
+
+class TestRebuild:
+
+    @pytest.fixture
+    def zkdir(self, tmp_path):
+        write_note(tmp_path, "190101120000", "diy", "First note")
+        write_note(tmp_path, "190102120000", "diy wood", "Second note, see zk://190101120000")
+        write_note(tmp_path, "190103120000", "", "Third note")
+        return str(tmp_path)
+
+    def test_unchanged_notes_are_kept(self, zkdir):
+        zk = zk2.ZK(zkdir, use_cache=False)
+        before = {n.id: n for n in zk._notes}
+        zk.rebuild_db()
+        assert all(before[n.id] is n for n in zk._notes)
+
+    def test_changed_and_deleted_notes(self, zkdir):
+        zk = zk2.ZK(zkdir, use_cache=False)
+        assert zk.note("190101120000")["backlinks"][0]["url"] == "zk://190102120000"
+        os.remove(os.path.join(zkdir, "zk190102120000.md"))
+        write_note(zkdir, "190103120000", "", "Third note, see zk://190101120000 " * 2)
+        zk.rebuild_db()
+        assert len(zk._notes) == 2
+        backlinks = zk.note("190101120000")["backlinks"]
+        assert [link["url"] for link in backlinks] == ["zk://190103120000"]
+
+    def test_cache(self, zkdir):
+        zk = zk2.ZK(zkdir, use_cache=True)
+        assert os.path.exists(os.path.join(zkdir, zk2.cache.CACHE_FILE))
+        write_note(zkdir, "190104120000", "new", "Fourth note, see zk://190101120000")
+        cached = zk2.ZK(zkdir, use_cache=True)
+        assert sorted(n.id for n in cached._notes) == sorted(n.id for n in zk._notes) + ["190104120000"]
+        assert cached.note("190102120000") == zk.note("190102120000")
+        assert len(cached.note("190101120000")["backlinks"]) == 2
+
+    def test_welcome_note(self, tmp_path):
+        zkdir = str(tmp_path / "notes")
+        zk = zk2.ZK(zkdir, use_cache=True)
+        assert [n.title for n in zk._notes] == ["Welcome!"]
+        os.remove(zk.filepath(zk._notes[0].id))
+        # The parse cache doesn't count as a note
+        assert os.listdir(zkdir) != []
+        zk.rebuild_db()
+        assert [n.title for n in zk._notes] == ["Welcome!"]
+        os.remove(zk.filepath(zk._notes[0].id))
+        assert [n.title for n in zk2.ZK(zkdir, use_cache=True)._notes] == ["Welcome!"]
+
+    def test_zk_tool_create(self, tmp_path, monkeypatch):
+        monkeypatch.setitem(zk2.config, "cache", True)
+        # No notes yet, only the parse cache and images
+        (tmp_path / "img").mkdir()
+        zk2.ZK(str(tmp_path), use_cache=True)
+        os.remove(next(tmp_path.glob("zk*.md")))
+        notepath = zk_tool.create(str(tmp_path), "New note")
+        zk = zk2.ZK(str(tmp_path), use_cache=True)
+        assert len(zk._notes) == 2 and "Welcome!" in [n.title for n in zk._notes]
+        assert zk.note(os.path.basename(notepath)[2:-3])["body"] == "New note"
+
+    def test_id_lookup(self, zkdir):
+        zk = zk2.ZK(zkdir, use_cache=False)
+        assert zk.filepath("190102120000") == os.path.join(zkdir, "zk190102120000.md")
+        assert sorted(n.id for n in zk.id_match("19010")) == ["190101120000", "190102120000", "190103120000"]
+        assert [n.id for n in zk.id_match("1901021")] == ["190102120000"]
+        note_id = zk.create("New note")
+        assert zk.note(note_id)["body"] == "New note"
+        assert [n.id for n in zk.id_match(note_id)] == [note_id]
+        zk.archive("190101120000")
+        assert "archived" in zk.note("190101120000")["tags"]
+
+    def test_duplicate_ids(self, zkdir):
+        zk = zk2.ZK(zkdir, use_cache=False)
+        original = os.path.join(zkdir, "zk190101120000.md")
+        conflict = os.path.join(zkdir, "zk190101120000 2.md")
+        with open(original) as fd:
+            text = fd.read()
+        # A sync conflict copy, with a link of its own
+        with open(conflict, "w") as fd:
+            fd.write(text + " see zk://190103120000")
+        zk.rebuild_db()
+        assert zk.filepath("190101120000") == original
+        assert zk.links("190101120000") == []
+        os.remove(original)
+        zk.rebuild_db()
+        assert zk.filepath("190101120000") == conflict
+        assert zk.note("190101120000")["body"].endswith("see zk://190103120000")
+        assert zk.backlinks("190103120000") == ["190101120000"]
+        assert [n.id for n in zk.id_match("190101")] == ["190101120000"]
+        os.remove(conflict)
+        zk.rebuild_db()
+        assert zk.filepath("190101120000") is None
+        assert zk.backlinks("190103120000") == []
+        assert [n.id for n in zk.id_match("190101")] == []
+
+    def test_link_graph(self, zkdir):
+        zk = zk2.ZK(zkdir, use_cache=False)
+        assert zk.backlinks("190101120000") == ["190102120000"]
+        assert zk.links("190102120000") == ["190101120000"]
+        assert zk.orphans() == ["190103120000"]
+        write_note(zkdir, "190103120000", "", "Third note, see zk://190102120000 and zk://190999999999")
+        zk.rebuild_db()
+        assert zk.orphans() == []
+        assert zk.links("190103120000") == ["190102120000"]
+        assert zk.neighbourhood("190101120000", hops=1) == {"190101120000": 0, "190102120000": 1}
+        assert zk.neighbourhood("190101120000", hops=2) == {"190101120000": 0, "190102120000": 1, "190103120000": 2}
+        assert zk.neighbourhood("190101120000", hops=2, direction="out") == {"190101120000": 0}
+        ids = lambda q: sorted(n.id for n in zk.execute_query(q))
+        assert ids("linksto:190101120000") == ["190102120000"]
+        assert ids("linksto:1901") == ["190102120000", "190103120000"]
+        assert ids("linkedfrom:190103120000") == ["190102120000"]
+        assert ids("wood linkedfrom:190103") == ["190102120000"]
+        assert ids("diy linksto:190102120000") == []
+        assert ids("is:orphan") == []
+        os.remove(os.path.join(zkdir, "zk190102120000.md"))
+        zk.rebuild_db()
+        assert ids("is:orphan") == ["190101120000", "190103120000"]
+        assert zk.note("190101120000")["backlinks"] == []
+
+    def test_batch(self, zkdir):
+        zk = zk2.ZK(zkdir, use_cache=True)
+        plan = zk.rename_tag("diy", "craft", dry_run=True)
+        assert [(r.action, os.path.basename(r.path)) for r in plan] == [("write", "zk190101120000.md"), ("write", "zk190102120000.md")]
+        assert zk.tags(mincount=1) == ["diy", "wood"]
+        results = zk.rename_tag("diy", "craft")
+        assert [r.error for r in results] == [None, None]
+        assert zk.tags(mincount=1) == ["craft", "wood"]
+        assert zk2.ZK(zkdir, use_cache=False).tags(mincount=1) == ["craft", "wood"]
+        assert not [f for f in os.listdir(zkdir) if f.endswith(".tmp")]
+        write_note(zkdir, "190104120000", "archived", "")
+        zk.archive("190103120000")
+        zk.rebuild_db()
+        assert [os.path.basename(r.path) for r in zk.purge_empty_archived()] == ["zk190104120000.md"]
+        assert sorted(n.id for n in zk._notes) == ["190101120000", "190102120000", "190103120000"]
+        assert zk.note("190103120000")["tags"] == ["archived"]
+        # The batch updated the cache
+        assert zk2.ZK(zkdir, use_cache=True).note("190101120000") == zk.note("190101120000")
+
+    def test_batch_changed_on_disk(self, zkdir):
+        zk = zk2.ZK(zkdir, use_cache=False)
+        # Edited behind the database's back, no refresh
+        write_note(zkdir, "190101120000", "diy", "First note, edited")
+        zk.archive("190101120000")
+        assert zk.note("190101120000")["body"] == "First note, edited"
+        assert zk2.ZK(zkdir, use_cache=False).note("190101120000")["tags"] == ["diy", "archived"]
+        write_note(zkdir, "190102120000", "diy wood", "Second note, edited")
+        zk.rename_tag("wood", "timber")
+        assert zk2.ZK(zkdir, use_cache=False).note("190102120000")["body"] == "Second note, edited"
+        # A file that changes between reading and committing is left alone
+        batch = zk.batch()
+        note = zk2.batch.editable(zk._note("190103120000"))
+        note.tags.append("late")
+        batch.write(note)
+        write_note(zkdir, "190103120000", "", "Third note, edited")
+        [result] = batch.commit()
+        assert isinstance(result.error, zk2.batch.ChangedOnDisk)
+        assert zk2.ZK(zkdir, use_cache=False).note("190103120000")["body"] == "Third note, edited"
+
+    def test_edit_in_background(self, zkdir, monkeypatch):
+        zk = zk2.ZK(zkdir, use_cache=False)
+        monkeypatch.setitem(zk2.config, "editor", "sleep 0.2; echo 'zk://190103120000' >>")
+        proc = zk.edit("190101120000")
+        assert proc.poll() is None
+        proc.wait()
+        time.sleep(0.1)
+        assert [link["url"] for link in zk.note("190103120000")["backlinks"]] == ["zk://190101120000"]
+
+    @pytest.mark.parametrize("use_inotify", [True, False])
+    def test_watcher(self, zkdir, use_inotify):
+        zk = zk2.ZK(zkdir, use_cache=False)
+        zk.watch(use_inotify=use_inotify, interval=0.05, debounce=0.05)
+        try:
+            write_note(zkdir, "190104120000", "watched", "New note")
+            with open(os.path.join(zkdir, ".zk190104120000.md.swp"), "w") as fd:
+                fd.write("junk")
+            os.remove(os.path.join(zkdir, "zk190103120000.md"))
+            time.sleep(0.3)
+            zk.refresh()
+            assert sorted(n.id for n in zk._notes) == ["190101120000", "190102120000", "190104120000"]
+        finally:
+            zk.unwatch()
+
+    def test_poll_interval(self, zkdir, monkeypatch):
+        zk = zk2.ZK(zkdir, use_cache=False)
+        watcher = zk2.watcher.Watcher(zk, use_inotify=False)
+        # Scales with the time a scan takes
+        watcher._scan_time = 0.001
+        assert watcher._poll_interval() == zk2.watcher.MIN_INTERVAL
+        watcher._scan_time = 0.5
+        assert watcher._poll_interval() == 0.5 * zk2.watcher.POLL_LOAD
+        monkeypatch.setitem(zk2.config, "watch_interval", 3)
+        assert zk2.watcher.Watcher(zk, use_inotify=False)._poll_interval() == 3
+
+    @pytest.mark.parametrize("use_inotify", [True, False])
+    def test_sharded_layout(self, zkdir, monkeypatch, use_inotify):
+        monkeypatch.setitem(zk2.config, "layout", "sharded")
+        shard = os.path.join(zkdir, "19", "01")
+        os.makedirs(shard)
+        write_note(shard, "190105120000", "diy", "Sharded note, see zk://190101120000")
+        # Only yy/mm directories are shards
+        for other in ("backup", os.path.join("19", "01", "02"), os.path.join("19", "old")):
+            os.makedirs(os.path.join(zkdir, other))
+            write_note(os.path.join(zkdir, other), "190107120000", "watched", "Not a note in the collection")
+        zk = zk2.ZK(zkdir, use_cache=False)
+        assert len(zk._notes) == 4
+        assert zk.filepath("190105120000") == os.path.join(shard, "zk190105120000.md")
+        assert len(zk.note("190101120000")["backlinks"]) == 2
+        # Existing notes stay where they are, new notes go into shards
+        zk.archive("190101120000")
+        assert zk.filepath("190101120000") == os.path.join(zkdir, "zk190101120000.md")
+        note_id = zk.create("New note")
+        assert zk.filepath(note_id) == note_path(zkdir, note_id, "sharded")
+        zk.watch(use_inotify=use_inotify, interval=0.05, debounce=0.05)
+        try:
+            os.makedirs(os.path.join(zkdir, "19", "02"))
+            write_note(os.path.join(zkdir, "19", "02"), "190201120000", "watched", "New shard")
+            write_note(shard, "190106120000", "watched", "Old shard")
+            time.sleep(0.3)
+            zk.refresh()
+            assert sorted(n["id"] for n in zk.filter(["watched"])) == ["190106120000", "190201120000"]
+        finally:
+            zk.unwatch()
+
+    @pytest.mark.parametrize("vectorized", [True, False])
+    def test_related(self, zkdir, monkeypatch, vectorized):
+        if vectorized:
+            pytest.importorskip("scipy")
+        else:
+            monkeypatch.setattr(zk2.related, "numpy", None)
+        write_note(zkdir, "190104120000", "wood", "Oak and birch plywood for the workbench top")
+        write_note(zkdir, "190105120000", "wood", "Workbench vise, oak jaws")
+        write_note(zkdir, "190106120000", "archived", "Old workbench plans, plywood and oak")
+        write_note(zkdir, "190107120000", "food", "Sourdough bread recipe")
+        zk = zk2.ZK(zkdir, use_cache=False)
+        assert [n["id"] for n in zk.related("190104120000")] == ["190105120000"]
+        assert [n["id"] for n in zk.related(text="sourdough starter")] == ["190107120000"]
+        assert zk.related("190104120000", k=0) == []
+        assert zk.related("nonexistent") == []
+        write_note(zkdir, "190108120000", "", "Birch plywood offcuts")
+        zk.rebuild_db()
+        assert [n["id"] for n in zk.related("190104120000")] == ["190108120000", "190105120000"]
+
+    def test_parallel_load(self, zkdir, monkeypatch):
+        for i in range(zk2.ZKDatabase.PARALLEL_LOAD_MIN):
+            write_note(zkdir, f"19020112{i // 60:02d}{i % 60:02d}", "many", f"Note {i}, see zk://190101120000")
+        monkeypatch.setitem(zk2.config, "load_workers", 1)
+        sequential = zk2.ZK(zkdir, use_cache=False)
+        monkeypatch.setitem(zk2.config, "load_workers", 4)
+        parallel = zk2.ZK(zkdir, use_cache=False)
+        assert [n._asdict() for n in parallel._notes] == [n._asdict() for n in sequential._notes]
+
+    def test_lazy_bodies(self, zkdir, monkeypatch):
+        monkeypatch.setitem(zk2.config, "lazy_bodies", True)
+        zk = zk2.ZK(zkdir, use_cache=False)
+        assert all(n._body is None for n in zk._notes)
+        assert [n["id"] for n in zk.query('"second')] == ["190102120000"]
+        notepath = os.path.join(zkdir, "zk190102120000.md")
+        header_only = zk2.ZKNote(notepath, header_only=True)
+        assert header_only._body is None
+        assert header_only._asdict() == zk2.ZKNote(notepath)._asdict()
+        assert all("body" not in n for n in zk.related(text="second note"))
+        # Lists of notes don't read the bodies
+        monkeypatch.setattr(zk2.ZKNote, "body", property(lambda note: pytest.fail("body read")))
+        assert all("body" not in n for n in zk.query(""))
+
+    @pytest.mark.parametrize("search_index", [True, False])
+    def test_lazy_bodies_changed_on_disk(self, zkdir, monkeypatch, search_index):
+        monkeypatch.setitem(zk2.config, "lazy_bodies", True)
+        zk = zk2.ZK(zkdir, use_cache=False, search_index=search_index)
+        # Removed or broken behind the database's back, no refresh
+        os.remove(os.path.join(zkdir, "zk190102120000.md"))
+        with open(os.path.join(zkdir, "zk190101120000.md"), "w") as fd:
+            fd.write("No header")
+        assert [n["id"] for n in zk.query('"note')] == ["190103120000"]
+        assert [n.id for n in zk.execute_query('"note')] == ["190103120000"]
+        assert [n["id"] for n in zk.search("note")] == ["190103120000"]
+        # and picked up by the next refresh
+        assert [n["id"] for n in zk.query("")] == ["190103120000"]
+
+    def test_concurrent_readers_and_writers(self, zkdir):
+        zk = zk2.ZK(zkdir, use_cache=False)
+        errors = []
+
+        def read():
+            try:
+                for _ in range(200):
+                    zk.query("")
+                    zk.tags(mincount=1)
+            except Exception as err:
+                errors.append(err)
+
+        def write():
+            try:
+                for i in range(20):
+                    write_note(zkdir, f"1902011200{i:02d}", "many", f"Note {i}, see zk://190101120000")
+                    zk.rebuild_db()
+                    zk.archive(f"1902011200{i:02d}")
+                zk.load_notes(zkdir)
+            except Exception as err:
+                errors.append(err)
+
+        threads = [threading.Thread(target=read) for _ in range(4)] + [threading.Thread(target=write)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        assert errors == []
+        assert len(zk.query("archived")) == 20
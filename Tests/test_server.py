@@ -0,0 +1,80 @@
+import re
+import pytest
+import zk2
+from zk2 import metrics
+
+from conftest import write_note
+
+flask = pytest.importorskip("flask")
+
+
+@pytest.fixture
+def zkdir(tmp_path, monkeypatch):
+    write_note(tmp_path, "190101120000", "diy", "First note about woodworking")
+    write_note(tmp_path, "190102120000", "diy wood", "Second note about woodworking, see zk://190101120000")
+    write_note(tmp_path, "190103120000", "", "Third note, on cooking")
+    monkeypatch.setitem(zk2.config, "notesdir", str(tmp_path))
+    monkeypatch.setitem(zk2.config, "cache", False)
+    monkeypatch.setitem(zk2.config, "watch", False)
+    return str(tmp_path)
+
+
+@pytest.fixture
+def client(zkdir):
+    from zk2.server import create_app
+    return create_app().test_client()
+
+
+def item_ids(response):
+    return re.findall(r'class="item" [^>]* id="(\d+)"', response.get_data(as_text=True))
+
+
+def test_query_paging(client):
+    response = client.get("/query/?key=date&reversed=false&limit=2")
+    assert response.headers["X-Total-Count"] == "3"
+    assert item_ids(response) == ["190101120000", "190102120000"]
+    response = client.get("/query/?key=date&reversed=false&offset=2&limit=2")
+    assert response.headers["X-Total-Count"] == "3"
+    assert item_ids(response) == ["190103120000"]
+    response = client.get("/query/diy")
+    assert response.headers["X-Total-Count"] == "2"
+    assert len(item_ids(response)) == 2
+
+
+def test_etag(client, zkdir):
+    response = client.get("/query/diy")
+    etag = response.headers["ETag"]
+    assert client.get("/query/diy", headers={"If-None-Match": etag}).status_code == 304
+    assert client.get("/note/190101120000", headers={"If-None-Match": etag}).status_code == 304
+    # A changed note changes the generation
+    write_note(zkdir, "190104120000", "diy", "Fourth note")
+    client.get("/")
+    response = client.get("/query/diy", headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.headers["ETag"] != etag
+    assert response.headers["X-Total-Count"] == "3"
+
+
+def test_related(client):
+    assert item_ids(client.get("/related/190102120000"))[0] == "190101120000"
+    assert item_ids(client.get("/related/?text=cooking")) == ["190103120000"]
+    assert len(item_ids(client.get("/related/?text=note&limit=2"))) == 2
+    assert item_ids(client.get("/related/190199999999")) == []
+
+
+def test_metrics(zkdir):
+    from zk2.server import create_app
+    metrics.reset()
+    metrics.enable()
+    try:
+        client = create_app().test_client()
+        response = client.get("/query/diy")
+        timing = response.headers["Server-Timing"]
+        assert "query;dur=" in timing and "total;dur=" in timing
+        text = client.get("/metrics").get_data(as_text=True)
+        assert 'zk2_stage_seconds_count{stage="request.query"} 1' in text
+    finally:
+        metrics.enable(False)
+        metrics.reset()
+    # Only served with metrics enabled
+    assert create_app().test_client().get("/metrics").status_code == 404
@@ -0,0 +1,209 @@
+#!/usr/bin/env python3
+
+# Benchmark ZK on synthetic collections, see synthetic.py
+#
+#   python3 benchmarks/bench.py --notes 1000,10000 --out results.json
+#   python3 benchmarks/bench.py --notes 10000 --compare results.json
+#
+# Collections are generated once into --workdir and reused by later runs.
+# Results are written as JSON, one entry per (collection size, benchmark)
+# with min/median/mean wall time in seconds over --repeat runs.
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import platform
+import statistics
+import subprocess
+import tempfile
+from datetime import datetime
+
+import zk2
+from zk2.cache import CACHE_FILE
+
+from synthetic import generate
+
+# Queries exercising each kind of query clause
+QUERIES = {
+    "all": "",
+    "tag": "python",
+    "tag_prefix": "w",
+    "tags": "python unix",
+    "untagged": "untagged",
+    "archived": "archived",
+    "id": "@1601",
+    "search_literal": '"network',
+    "search_regex": '"pa[tr]h.*node',
+    "tag_search": 'python "loop',
+    "tag_search_id": 'zk "link @16',
+    "links_to": "linksto:16",
+    "orphan": "is:orphan",
+}
+
+
+def timed(fn, repeat, setup=None):
+    # Returns ([seconds per run], result of the last run)
+    times = []
+    result = None
+    for _ in range(repeat):
+        if setup:
+            setup()
+        start = time.perf_counter()
+        result = fn()
+        times.append(time.perf_counter() - start)
+    return (times, result)
+
+
+def summary(times):
+    return {
+        "min": min(times),
+        "median": statistics.median(times),
+        "mean": statistics.fmean(times),
+        "runs": len(times),
+    }
+
+
+def collection(workdir, count, seed):
+    # Generated notes dir, reused if a previous run completed it
+    zkdir = os.path.join(workdir, f"zk-{count}-{seed}")
+    done = os.path.join(zkdir, ".complete")
+    if not os.path.exists(done):
+        shutil.rmtree(zkdir, ignore_errors=True)
+        generate(zkdir, count, seed)
+        open(done, "w").close()
+    return zkdir
+
+
+def drop_cache(zkdir):
+    for suffix in ("", "-wal", "-shm"):
+        try:
+            os.remove(os.path.join(zkdir, CACHE_FILE + suffix))
+        except FileNotFoundError:
+            pass
+
+
+def bench_collection(zkdir, repeat, seed):
+    # Returns {benchmark: summary}
+    results = {}
+    rnd = random.Random(seed)
+
+    def record(name, fn, setup=None, runs=repeat):
+        (times, result) = timed(fn, runs, setup)
+        results[name] = summary(times)
+        return result
+
+    record("construct_nocache", lambda: zk2.ZK(zkdir, use_cache=False))
+    record("construct_cold", lambda: zk2.ZK(zkdir, use_cache=True), setup=lambda: drop_cache(zkdir))
+    zk = record("construct_warm", lambda: zk2.ZK(zkdir, use_cache=True))
+
+    record("rebuild_db_unchanged", zk.rebuild_db)
+    ids = [n.id for n in zk._notes]
+    notepaths = [zk.filepath(i) for i in rnd.sample(ids, max(1, len(ids) // 100))]
+
+    def touch():
+        # Make 1% of the notes look changed, without changing the collection
+        for notepath in notepaths:
+            st = os.stat(notepath)
+            os.utime(notepath, ns=(st.st_atime_ns, st.st_mtime_ns + 1000))
+    record("rebuild_db_1pct_changed", zk.rebuild_db, setup=touch)
+
+    for name, query in QUERIES.items():
+        record(f"query_{name}", lambda: zk.execute_query(query))
+    # Without the query memo, i.e. the cost of the query and the sort
+    record("query_page_date_limit_100", lambda: zk.query_page("", offset=0, limit=100), setup=zk._memo.clear)
+    record("query_page_title_tag_all", lambda: zk.query_page("python", sort_key="title"), setup=zk._memo.clear)
+    record("query_page_memo_hit", lambda: zk.query_page("python", sort_key="title"))
+    record("tags", lambda: zk.tags(mincount=6))
+
+    sample = rnd.sample(ids, min(100, len(ids)))
+    record("note_x100", lambda: [zk.note(i) for i in sample])
+    # The first lookup also tokenizes all notes
+    record("related_first", lambda: zk.related(sample[0]), runs=1)
+    record("related_x10", lambda: [zk.related(i) for i in sample[:10]])
+
+    try:
+        from zk2.server import mdproc
+    except ImportError as err:
+        # The server's dependencies aren't installed
+        results["render_x100"] = {"skipped": str(err)}
+    else:
+        bodies = [(i, zk.note(i)["body"]) for i in sample]
+        record("render_x100", lambda: [mdproc.render(b) for (_, b) in bodies], runs=max(1, repeat // 3))
+        record("render_cached_x100", lambda: [mdproc.render(b, note_id=i) for (i, b) in bodies])
+    return results
+
+
+def git_revision():
+    try:
+        out = subprocess.run(
+            ["git", "describe", "--always", "--dirty"], capture_output=True, text=True,
+            cwd=os.path.dirname(os.path.abspath(__file__))
+        )
+    except OSError:
+        return None
+    return out.stdout.strip() or None
+
+
+def compare(old, new):
+    # Print median ratios new/old for benchmarks present in both runs
+    old_results = {(r["notes"], r["benchmark"]): r for r in old["results"]}
+    print(f"{'notes':>7}  {'benchmark':<28} {'old ms':>10} {'new ms':>10} {'ratio':>7}")
+    for r in new["results"]:
+        o = old_results.get((r["notes"], r["benchmark"]))
+        if not o or "median" not in o or "median" not in r:
+            continue
+        ratio = r["median"] / o["median"] if o["median"] else float("inf")
+        flag = "  <--" if ratio > 1.2 else ""
+        print(f"{r['notes']:>7}  {r['benchmark']:<28} {o['median'] * 1000:>10.3f} {r['median'] * 1000:>10.3f} {ratio:>7.2f}{flag}")
+
+
+def app():
+    parser = argparse.ArgumentParser(description="Benchmark ZK on synthetic note collections")
+    parser.add_argument('--notes', default="1000,10000",
+                        help="Comma separated collection sizes (default 1000,10000)")
+    parser.add_argument('--repeat', type=int, default=5, help="Runs per benchmark (default 5)")
+    parser.add_argument('--seed', type=int, default=1, help="Random seed (default 1)")
+    parser.add_argument('--workdir', default=os.path.join(tempfile.gettempdir(), "zk2-bench"),
+                        help="Where to keep generated collections")
+    parser.add_argument('--out', help="Write JSON results to file (default stdout)")
+    parser.add_argument('--compare', metavar="JSON", help="Compare with results of an earlier run")
+    args = parser.parse_args()
+
+    sizes = [int(n) for n in args.notes.split(",")]
+    old = None
+    if args.compare:
+        with open(args.compare) as fd:
+            old = json.load(fd)
+    report = {
+        "revision": git_revision(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "repeat": args.repeat,
+        "seed": args.seed,
+        "config": {k: v for k, v in zk2.config.items() if k not in ("notesdir", "editor")},
+        "results": [],
+    }
+    for count in sizes:
+        zkdir = collection(args.workdir, count, args.seed)
+        print(f"Benchmarking {count} notes in {zkdir}", file=sys.stderr)
+        for name, result in bench_collection(zkdir, args.repeat, args.seed).items():
+            report["results"].append({"notes": count, "benchmark": name, **result})
+
+    text = json.dumps(report, indent=2)
+    if args.out:
+        with open(args.out, "w") as fd:
+            fd.write(text + "\n")
+    elif not args.compare:
+        print(text)
+    if old:
+        compare(old, report)
+
+
+if __name__ == '__main__':
+    app()
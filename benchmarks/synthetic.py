@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+
+# Generate a synthetic Zettelkasten for benchmarking
+#
+# Notes are written in the regular ZKNote format. The collection is
+# deterministic for a given size and seed:
+# - IDs/dates spread over the years since 2014, a few minutes apart
+# - 0-5 tags per note, drawn from a skewed (Zipf-like) distribution,
+#   about 5% of the notes are archived and a few are untagged
+# - about half of the notes have a Title header, the rest get their title
+#   from the start of the body
+# - 0-4 zk:// links per note, mostly to recent notes
+# - body sizes log-normally distributed around ~1 kB, a few large notes
+
+import os
+import sys
+import math
+import random
+import argparse
+from datetime import datetime, timedelta
+
+import zk2
+from zk2 import definitions as defs
+
+START_DATE = datetime(2014, 1, 1, 8, 0, 0)
+
+WORDS = """
+    able about above across action actually after again against algorithm also always among analysis
+    another answer approach area argument around article aspect assume attention author available back
+    balance base because become before begin behind being believe benefit better between beyond board
+    body book both bottom bring build business call capture case cause center certain chain change chapter
+    check choice claim class clear close code collection come common complex concept condition connect
+    consider context continue control core cost could course create current data decide deep define
+    design detail develop different direct discuss distance document draft during each early edge effect
+    either element else energy enough entire entry error even event every evidence example expect
+    experience explain fact factor field figure file final find first focus follow form frame function
+    future general given goal good graph group grow half hand handle hard head hear help hidden high
+    history hold idea image impact important include index input inside instead interest issue item
+    just keep kind know language large last later layer lead learn least leave level light limit line
+    link list little local long look loop machine main make manage many mark matter mean measure memory
+    method middle might mind model moment more most move much name nature near need network never next
+    node note number object often open order other output over page paper part path pattern people
+    perhaps place plan plane point position possible power practice present problem process project
+    property question quick quite range rather read reason record reference relation remember report
+    result review right role rule same sample scale search section see sense series set shape short
+    should show side signal simple since single size slow small some source space special stack stage
+    start state step still store structure study style subject system table take task term test text
+    than that their theory there thing think through time together tool topic track tree true type under
+    until update usage value version view wait want way while whole wood word work world write year
+""".split()
+
+TAGS = """
+    zk howto workflow python c rust go swift javascript css html markdown unix shell git emacs vim
+    textmate macos linux network security crypto math statistics physics electronics arduino raspberrypi
+    diy woodworking workshop tools metal 3dprinting cooking recipe coffee bread travel books reading
+    writing quotes ideas project work meeting todo review research paper thesis teaching music guitar
+    photography camera film design typography color ui ux web server database sql sqlite performance
+    testing debugging algorithms datastructures compilers parsing regex unicode fonts latex pdf
+    finance health running cycling hiking garden house family kids history philosophy psychology
+    language german swedish spanish ml ai robotics control signal dsp audio video streaming
+""".split()
+
+
+def zipf_weights(n, s=1.1):
+    return [1.0 / (rank ** s) for rank in range(1, n + 1)]
+
+
+def make_body(rnd, size, links):
+    # Markdown-ish text of about size characters, with links sprinkled in
+    paragraphs = []
+    length = 0
+    while length < size:
+        sentences = []
+        for _ in range(rnd.randint(2, 6)):
+            words = rnd.choices(WORDS, k=rnd.randint(6, 20))
+            sentences.append(" ".join(words).capitalize() + ".")
+        paragraph = " ".join(sentences)
+        if rnd.random() < 0.1:
+            paragraph = "## " + " ".join(rnd.choices(WORDS, k=3)).title() + "\n\n" + paragraph
+        elif rnd.random() < 0.1:
+            paragraph = "\n".join(f"- {' '.join(rnd.choices(WORDS, k=5))}" for _ in range(4))
+        paragraphs.append(paragraph)
+        length += len(paragraph) + 2
+    for target in links:
+        i = rnd.randrange(len(paragraphs))
+        label = " ".join(rnd.choices(WORDS, k=2))
+        paragraphs[i] += f" See [{label}](zk://{target})."
+    return "\n\n".join(paragraphs) + "\n"
+
+
+def generate(zkdir, count, seed=1):
+    """
+    Write count synthetic notes to zkdir.
+
+    Returns:
+        list: IDs of the generated notes, in creation order.
+    """
+    rnd = random.Random(seed)
+    tag_weights = zipf_weights(len(TAGS))
+    os.makedirs(zkdir, exist_ok=True)
+    # Spread the notes over the years since START_DATE
+    step = max(1, int(10 * 365 * 24 * 60 / count))
+    date = START_DATE
+    ids = []
+    for i in range(count):
+        date += timedelta(minutes=rnd.randint(1, 2 * step), seconds=rnd.randint(0, 59))
+        note_id = date.strftime("%y%m%d%H%M%S")
+        tags = set(rnd.choices(TAGS, weights=tag_weights, k=rnd.choice([0, 1, 1, 2, 2, 2, 3, 3, 4, 5])))
+        if rnd.random() < 0.05:
+            tags.add(defs.ARCHIVED)
+        if ids:
+            # Mostly link to recent notes, sometimes to anything
+            links = set()
+            for _ in range(rnd.choice([0, 0, 1, 1, 1, 2, 2, 3, 4])):
+                if rnd.random() < 0.7:
+                    j = max(0, len(ids) - 1 - int(rnd.expovariate(1 / 20)))
+                else:
+                    j = rnd.randrange(len(ids))
+                links.add(ids[j])
+        else:
+            links = set()
+        size = int(min(rnd.lognormvariate(math.log(900), 0.8), 64 * 1024))
+        body = make_body(rnd, size, sorted(links))
+        title = " ".join(rnd.choices(WORDS, k=rnd.randint(2, 5))).capitalize() if rnd.random() < 0.5 else ""
+        modified = date + timedelta(days=rnd.randint(0, 400)) if rnd.random() < 0.3 else date
+        note = zk2.ZKNote(data={
+            defs.DATE: date,
+            defs.MODIFIED: modified,
+            defs.ID: note_id,
+            defs.AUTHOR: "Bench Marker",
+            defs.TAGS: sorted(tags),
+            defs.TITLE: title,
+            defs.BODY: body,
+        })
+        note.write(zkdir)
+        ids.append(note_id)
+    return ids
+
+
+def app():
+    parser = argparse.ArgumentParser(description="Generate a synthetic Zettelkasten for benchmarking")
+    parser.add_argument('zkdir', help="Directory to write notes to")
+    parser.add_argument('--notes', type=int, default=1000, help="Number of notes (default 1000)")
+    parser.add_argument('--seed', type=int, default=1, help="Random seed (default 1)")
+    args = parser.parse_args()
+    if os.path.isdir(args.zkdir) and os.listdir(args.zkdir):
+        sys.exit(f"Error: {args.zkdir} is not empty")
+    generate(args.zkdir, args.notes, args.seed)
+
+
+if __name__ == '__main__':
+    app()
@@ -1,11 +1,25 @@
 import os
-import re
+import copy
+import heapq
+import bisect
+import threading
 import subprocess
-from collections import namedtuple, defaultdict
+from datetime import timedelta
+from itertools import islice
+from concurrent.futures import ThreadPoolExecutor
 
-from zk2.ZKNote import ZKNote
+from zk2.ZKNote import ZKNote, MalformedNote, scan_note_files
 from . import definitions as defs
-from . import config
+from .config import conf
+from . import metrics
+from .cache import NoteCache
+from .index import TagIndex, TextIndex, SortIndex, LinkGraph
+from .related import RelatedIndex
+from .watcher import Watcher
+from .batch import Batch, editable
+from .query import parse_query, search_regex
+from .memo import QueryMemo, QueryResult
+from .rwlock import RWLock, reader, writer
 
 # File format:
 # 0. Tagline
@@ -35,226 +49,735 @@ from . import config
 #
 note_factory = ZKNote
 
-re_zk_link = re.compile(defs.ZK_LINK_REGEX)
-re_query = re.compile(defs.ZK_QUERY_REGEX)
+
+# Query results covering at least 1/SORT_WALK_RATIO of all notes are ordered
+# by walking a presorted index, smaller results are sorted directly
+SORT_WALK_RATIO = 8
+
+# Number of query results kept by query_page, see memo.py
+QUERY_MEMO_SIZE = 64
+
+# Below this number of files to parse, parallel loading isn't worth the overhead
+PARALLEL_LOAD_MIN = 64
+
+
+def copy_order(notepath):
+    # Of several files with the same ID (e.g. "zk<ID>.md" and a sync conflict
+    # copy "zk<ID> 2.md") the first in this order owns the ID
+    return (len(notepath), notepath)
+
+
+def read_note(notepath):
+    # Returns None if the file has disappeared or isn't a valid note
+    # (no header, bad dates, not UTF-8), such files are skipped
+    try:
+        return note_factory(notepath)
+    except (FileNotFoundError, ValueError):
+        return None
 
 
 #
 # ZK class to query note collection
 #
+# Thread safety: queries hold self._lock for reading, mutations (create,
+# archive, ...) hold it for writing. Note files are read and parsed without
+# holding the lock, readers are only blocked while the results are applied.
+# A full load_notes() builds a complete new snapshot of the database state
+# and swaps it in, readers keep using the previous one until then.
+#
 class ZK(object):
     """docstring for ZK"""
 
+    # Attributes making up the in-memory database state, see load_notes
+    _state = (
+        "_files", "_paths", "_copies", "_ids", "_stats", "_link_graph",
+        "_tag_index", "_text_index", "_sort_indexes", "_related", "_notes",
+    )
+
     sort_options = {
         defs.DATE: lambda x: x.date,
         defs.MODIFIED: lambda x: x.modified,
         defs.TITLE: lambda x: x.title,
     }
 
-    def __init__(self, notesdir=None):
+    def __init__(self, notesdir=None, use_cache=None, search_index=None):
         super(ZK, self).__init__()
-        self.zkdir = os.path.expanduser(notesdir or config.conf["notesdir"])
-        self._sort_key = defs.DATE
-        # FIXME: Use transient sort_key and sort_reversed
-        self._sort_fn = self.sort_options[self._sort_key]
-        self.sort_reversed = True
-        self.rebuild_db()
+        self.zkdir = os.path.expanduser(notesdir or conf["notesdir"])
+        use_cache = conf["cache"] if use_cache is None else use_cache
+        self._cache = NoteCache(self.zkdir) if use_cache else None
+        self._use_search_index = conf["search_index"] if search_index is None else search_index
+        # Keep only headers in memory, bodies are read from file when needed
+        self._lazy_bodies = conf["lazy_bodies"]
+        self._subscribers = []
+        self._pending = set()
+        self._pending_lock = threading.Lock()
+        self._watcher = None
+        self._lock = RWLock()
+        # Bumped by every change to the in-memory database
+        self._generation = 0
+        self._memo = QueryMemo(QUERY_MEMO_SIZE)
+        self._reset_state()
+        os.makedirs(self.zkdir, exist_ok=True)
+        self.load_notes(self.zkdir)
+        if not self._files and self._maybe_init_db():
+            self.update_notes(self.zkdir)
 
     def _welcome_note(self):
         welcome = ZKNote()
-        welcome.data[defs.TITLE] = "Welcome!"
-        welcome.data[defs.TAGS] = ["howto", "workflow"]
+        welcome.title = "Welcome!"
+        welcome.tags = ["howto", "workflow"]
         body = "Error locating README"
         this_dir = os.path.dirname(os.path.realpath(__file__))
         # FIXME: Fragile
         with open(this_dir + '/../../README.md') as fd:
             body = fd.read()
-        welcome.data[defs.BODY] = body
+        welcome.body = body
         welcome.write(self.zkdir)
 
     def _maybe_init_db(self):
-        try:
-            os.makedirs(self.zkdir)
-        except FileExistsError:
-            pass
-        if not os.listdir(self.zkdir):
-            self._welcome_note()
-
-    @property
-    def sort_key(self):
-        return self._sort_key
-
-    @sort_key.setter
-    def sort_key(self, key):
+        # Returns True if the welcome note was written to an empty notes dir.
+        # Only note files count, the notes dir also holds e.g. the parse cache.
+        os.makedirs(self.zkdir, exist_ok=True)
+        if scan_note_files(self.zkdir):
+            return False
+        self._welcome_note()
+        return True
+
+    def _sort_field(self, key):
+        # Unknown sort keys sort by date
         key = key.lower()
-        try:
-            self._sort_fn = self.sort_options[key]
-            self._sort_key = key
-        except KeyError:
-            self.sort_key = defs.DATE
+        return key if key in self.sort_options else defs.DATE
 
     def all_note_files(self, zkdir):
-        for filename in os.listdir(zkdir):
-            (name, ext) = os.path.splitext(filename)
-            # if ext != '.zk':
-            if ext != ".md" or not name.startswith("zk"):
-                continue
-            notepath = os.path.join(zkdir, filename)
-            yield notepath
+        yield from scan_note_files(zkdir)
 
-    def load_notes(self, zkdir):
-        self._notes = [note_factory(note) for note in self.all_note_files(zkdir)]
-        backlinks = defaultdict(list)
-        for note in self._notes:
-            match = re_zk_link.findall(note.body)
-            for m in match:
-                backlinks[m].append(
-                    {"url": f"zk://{note.id}", "title": f"{note.title}"}
-                )
-        for note in self._notes:
-            note.set_backlinks(backlinks.get(f"zk://{note.id}", []))
-
-    def execute_query(self, query_string):
-        m = re_query.match(query_string)
-        if not m:
-            return []
-        q_tags = m.group(1).rstrip().split(' ') if m.group(1) else None
-        q_search = m.group(2).strip('"').strip(' ') if m.group(2) else None
-        q_id = m.group(3).lstrip('@').rstrip(' ') if m.group(3) else None
+    def scan_note_files(self, zkdir):
+        # Returns {notepath: (mtime_ns, size)} of notes in zkdir and its subdirectories
+        return scan_note_files(zkdir)
 
-        tag_notes = self._filter(q_tags)
-        search_notes = self._search(q_search) if q_search else tag_notes
-        id_notes = self.id_match(q_id) if q_id else tag_notes
+    def load_notes(self, zkdir):
+        # Full (re)load into a new snapshot that replaces the current state when done
+        snapshot = copy.copy(self)
+        snapshot._lock = RWLock()
+        snapshot._subscribers = []
+        snapshot._memo = QueryMemo(0)
+        snapshot._reset_state()
+        snapshot.update_notes(zkdir)
+        with self._lock.write():
+            modified = set(self._paths) | set(snapshot._paths)
+            for attr in self._state:
+                setattr(self, attr, getattr(snapshot, attr))
+            self._changed()
+        for callback in self._subscribers:
+            callback(modified)
+
+    def _reset_state(self):
+        self._files = {}
+        self._paths = {}
+        self._copies = {}
+        self._ids = None
+        self._stats = {}
+        self._link_graph = LinkGraph()
+        self._tag_index = TagIndex()
+        self._text_index = TextIndex() if self._use_search_index else None
+        self._sort_indexes = {key: SortIndex(fn) for key, fn in self.sort_options.items()}
+        self._related = RelatedIndex()
+        self._notes = []
 
-        return list(set.intersection(set(tag_notes), set(search_notes), set(id_notes)))
+    def _stat_paths(self, notepaths):
+        stats = {}
+        for notepath in notepaths:
+            try:
+                st = os.stat(notepath)
+            except FileNotFoundError:
+                continue
+            stats[notepath] = (st.st_mtime_ns, st.st_size)
+        return stats
+
+    def update_notes(self, zkdir, notepaths=None):
+        # Incremental load, only (re)parse files whose mtime or size changed
+        # If notepaths is given, only those files are checked
+        with metrics.timer("scan"):
+            if notepaths is None:
+                stats = self.scan_note_files(zkdir)
+            else:
+                stats = self._stat_paths(notepaths)
+            with self._lock.read():
+                changed, removed = self._changes(stats, notepaths)
+        metrics.count("notes_scanned", len(stats))
+        if not changed and not removed:
+            return
+        with metrics.timer("cache_load"):
+            cached = self._cache.load({p: stats[p] for p in changed}) if self._cache else {}
+        with metrics.timer("parse"):
+            read = self._read_notes([p for p in changed if p not in cached])
+        metrics.count("cache_hits", len(cached))
+        metrics.count("notes_parsed", len(read))
+        with metrics.timer("apply"), self._lock.write():
+            # Recheck, another thread may have applied (some of) the changes
+            changed, removed = self._changes(stats, notepaths, changed)
+            (parsed, modified) = self._apply_changes(stats, changed, removed, cached, read)
+        self._changes_applied(parsed, changed, removed, modified)
+
+    def _apply_batch(self, written, removed):
+        # Take in notes written by a Batch ({notepath: note}) without re-reading them
+        stats = self._stat_paths(list(written) + list(removed))
+        with self._lock.write():
+            removed = [p for p in removed if p in self._stats and p not in stats]
+            changed = [p for p in written if p in stats]
+            (parsed, modified) = self._apply_changes(stats, changed, removed, {}, written)
+        self._changes_applied(parsed, changed, removed, modified)
+
+    def _changes_applied(self, parsed, changed, removed, modified):
+        if self._cache:
+            with metrics.timer("cache_store"):
+                self._cache.store(parsed, removed)
+        if self._lazy_bodies:
+            for notepath in changed:
+                note = self._files.get(notepath)
+                if note:
+                    note.unload_body()
+        if modified:
+            for callback in self._subscribers:
+                callback(modified)
+
+    def _changes(self, stats, notepaths, candidates=None):
+        # Returns ([changed paths], [removed paths]) relative to the current state
+        if notepaths is None:
+            removed = [p for p in self._stats if p not in stats]
+        else:
+            removed = [p for p in notepaths if p in self._stats and p not in stats]
+        candidates = stats if candidates is None else candidates
+        changed = [p for p in candidates if self._stats.get(p) != stats[p]]
+        return (changed, removed)
+
+    def _apply_changes(self, stats, changed, removed, cached, read):
+        # Returns ([(notepath, stat, note, links)] of parsed notes, {modified IDs})
+        parsed = []
+        affected = set()
+        modified = {self._files[p].id for p in removed + changed if p in self._files}
+        for notepath in removed:
+            del self._stats[notepath]
+            affected |= self._drop_note(notepath)
+        for notepath in changed:
+            affected |= self._drop_note(notepath)
+            if notepath in cached:
+                data, links = cached[notepath]
+                note = note_factory(notepath, data=data)
+            else:
+                note = read[notepath]
+                if note is None:
+                    # Deleted after the stat or malformed, try again next time
+                    self._stats.pop(notepath, None)
+                    continue
+                links = note.links()
+                parsed.append((notepath, stats[notepath], note, links))
+            affected |= self._add_note(notepath, note, links)
+            modified.add(note.id)
+            self._stats[notepath] = stats[notepath]
+        self._notes = list(self._files.values())
+        self._update_backlinks(affected)
+        if modified:
+            self._changed()
+        return (parsed, modified)
+
+    def _changed(self):
+        # Called holding the write lock whenever the database changes
+        self._generation += 1
+        self._memo.clear()
 
+    @property
+    def generation(self):
+        # Changes whenever the result of any query may have changed
+        return self._generation
+
+    def subscribe(self, callback):
+        # Call callback(note_ids) with the IDs of added, changed or removed notes
+        # whenever the database picks up changes
+        self._subscribers.append(callback)
+
+    def _read_notes(self, notepaths):
+        # Parse files, concurrently for larger batches (I/O bound on synced dirs)
+        # Returns {notepath: note or None}
+        workers = conf["load_workers"]
+        if workers > 1 and len(notepaths) >= PARALLEL_LOAD_MIN:
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                notes = list(pool.map(read_note, notepaths))
+        else:
+            notes = [read_note(p) for p in notepaths]
+        return dict(zip(notepaths, notes))
+
+    def _add_note(self, notepath, note, targets=None):
+        # Returns IDs whose backlinks are affected
+        self._files[notepath] = note
+        if note.id not in self._paths and self._ids is not None:
+            bisect.insort(self._ids, note.id)
+        copies = self._copies.setdefault(note.id, set())
+        copies.add(notepath)
+        owner = min(copies, key=copy_order)
+        self._paths[note.id] = owner
+        self._tag_index.add(notepath, note.tags)
+        for index in self._sort_indexes.values():
+            index.add(notepath, note)
+        if self._text_index:
+            self._text_index.add(notepath, note)
+        self._related.add(notepath, note)
+        if owner != notepath:
+            # Duplicate ID, the links belong to the note that owns the ID
+            return {note.id}
+        if targets is None:
+            targets = note.links()
+        previous = self._link_graph.remove(note.id)
+        self._link_graph.add(note.id, targets)
+        return previous | targets | {note.id}
+
+    def _drop_note(self, notepath):
+        # Returns IDs whose backlinks are affected
+        note = self._files.pop(notepath, None)
+        if note is None:
+            return set()
+        copies = self._copies[note.id]
+        copies.discard(notepath)
+        if self._paths.get(note.id) != notepath:
+            # Duplicate ID, the links belong to the note that owns the ID
+            targets = set()
+        elif copies:
+            # Duplicate ID, hand it over to a remaining copy
+            owner = min(copies, key=copy_order)
+            self._paths[note.id] = owner
+            targets = self._link_graph.remove(note.id)
+            self._link_graph.add(note.id, self._files[owner].links())
+            targets |= self._link_graph.outgoing(note.id) | {note.id}
+        else:
+            del self._copies[note.id]
+            del self._paths[note.id]
+            if self._ids is not None:
+                del self._ids[bisect.bisect_left(self._ids, note.id)]
+            targets = self._link_graph.remove(note.id)
+        self._tag_index.remove(notepath)
+        for index in self._sort_indexes.values():
+            index.remove(notepath)
+        if self._text_index:
+            self._text_index.remove(notepath)
+        self._related.remove(notepath)
+        return targets
+
+    def _backlinks(self, note_id):
+        sources = sorted(
+            (n for n in map(self._note, self._link_graph.incoming(note_id)) if n),
+            key=lambda n: n.id
+        )
+        return [{"url": f"zk://{n.id}", "title": f"{n.title}"} for n in sources]
+
+    def _update_backlinks(self, note_ids):
+        for note_id in note_ids:
+            note = self._note(note_id)
+            if note:
+                note.set_backlinks(self._backlinks(note_id))
+
+    @reader
+    def execute_query(self, query_string):
+        return [self._files[p] for p in self._execute_query(query_string)]
+
+    def _execute_query(self, query_string):
+        # Returns the set of paths of matching notes
+        (_, narrow) = self._plan(parse_query(query_string))
+        return narrow(None)
+
+    # Query planning, see query.py for the AST
+    # _plan(node) returns ((cost, estimated size), narrow) where narrow(paths)
+    # returns the subset of paths matching node, paths=None meaning all notes.
+    # A new set is returned, paths is left untouched.
+
+    def _plan(self, node):
+        return getattr(self, "_plan_" + type(node).__name__.lower())(node)
+
+    def _plan_and(self, node):
+        # Evaluate items in order of (cost, estimated result size), each
+        # item only looks at the candidates that survived the previous ones.
+        # Regex search is always last, it has to look at the note text.
+        plans = sorted((self._plan(n) for n in node.items), key=lambda p: p[0])
+
+        def narrow(paths):
+            for _, narrow_item in plans:
+                paths = narrow_item(paths)
+                if not paths:
+                    return set()
+            return paths
+        return ((max(p[0][0] for p in plans), min(p[0][1] for p in plans)), narrow)
+
+    def _plan_or(self, node):
+        plans = [self._plan(n) for n in node.items]
+
+        def narrow(paths):
+            result = set()
+            for _, narrow_item in plans:
+                result |= narrow_item(paths)
+            return result
+        cost = max((p[0][0] for p in plans), default=0)
+        return ((cost, min(len(self._files), sum(p[0][1] for p in plans))), narrow)
+
+    def _plan_not(self, node):
+        ((cost, estimate), narrow_item) = self._plan(node.item)
+
+        def narrow(paths):
+            return (set(self._files) if paths is None else paths) - narrow_item(paths)
+        return ((cost, len(self._files) - estimate), narrow)
+
+    def _plan_all(self, node):
+        def narrow(paths):
+            return set(self._files) if paths is None else set(paths)
+        return ((0, len(self._files)), narrow)
+
+    def _matching(self, matches):
+        # Plan for a precomputed set of paths
+        def narrow(paths):
+            return set(matches) if paths is None else matches & paths
+        return ((0, len(matches)), narrow)
+
+    def _plan_tag(self, node):
+        index = self._tag_index
+        estimate = index.prefix_size(node.prefix)
+
+        def narrow(paths):
+            if paths is not None and len(paths) < estimate:
+                # Cheaper to check the few candidates than to expand the prefix
+                return {p for p in paths if index.match(p, node.prefix)}
+            matches = index.prefix(node.prefix)
+            return matches if paths is None else matches & paths
+        return ((0, estimate), narrow)
+
+    def _plan_is(self, node):
+        if node.what == defs.ARCHIVED:
+            return self._matching(self._tag_index.archived)
+        if node.what == "untagged":
+            return self._matching(self._tag_index.untagged)
+        if node.what == "orphan":
+            return self._matching({self._paths[i] for i in self._link_graph.orphans(self._paths)})
+        return self._matching(set())
+
+    def _plan_id(self, node):
+        return self._matching({self._paths[i] for i in self._id_range(node.prefix)})
+
+    def _plan_link(self, node):
+        ids = self._id_range(node.prefix)
+        if node.kind == "linksto":
+            ids = self._link_graph.linked(ids)
+        else:
+            ids = self._link_graph.linked_from(ids)
+        return self._matching({self._paths[i] for i in ids if i in self._paths})
+
+    def _plan_date(self, node):
+        return self._matching(self._sort_indexes[node.field].range(node.start, node.end))
+
+    def _plan_search(self, node):
+        query_re = search_regex(node.pattern)
+        candidates = None
+        if node.field == defs.BODY and self._text_index:
+            candidates = self._candidates(query_re.pattern)
+
+        def narrow(paths):
+            if candidates is not None:
+                paths = candidates if paths is None else paths & candidates
+            elif paths is None:
+                paths = self._files
+            return {p for p in paths if query_re.search(self._text(self._files[p], node.field))}
+        return ((1, len(self._files) if candidates is None else len(candidates)), narrow)
+
+    def _id_range(self, prefix):
+        # IDs starting with prefix, as a range in the sorted list of IDs
+        if self._ids is None:
+            self._ids = sorted(self._paths)
+        lo = bisect.bisect_left(self._ids, prefix)
+        hi = bisect.bisect_left(self._ids, prefix + "\U0010ffff", lo)
+        return self._ids[lo:hi]
+
+    @reader
     def id_match(self, query):
-        return [n for n in self._notes if n.id.startswith(query)]
+        return [self._note(note_id) for note_id in self._id_range(query)]
 
     # Partial match, see https://stackoverflow.com/a/14389112
     # FIXME: Combined query expression covering all kinds
     # Argument query is list of (possibly partial) tags
     # Empty list matches everything
     def _filter(self, tags):
+        index = self._tag_index
         if not tags:
-            return [n for n in self._notes if defs.ARCHIVED not in n.tags]
+            return [n for p, n in self._files.items() if p not in index.archived]
         elif len(tags) == 1 and tags[0] == "untagged":
             # Return untagged notes
-            r = [n for n in self._notes if not n.tags]
+            paths = index.untagged
         else:
-            # Match against tags in query
-            r = []
-            for n in self._notes:
-                # Skip notes tagged with ARCHIVED unless ARCHIVED is part of query
-                if defs.ARCHIVED in n.tags and defs.ARCHIVED not in tags:
-                    continue
-                for q in tags:
-                    if any(t for t in n.tags if t.lower().startswith(q.lower())):
-                        continue
-                    else:
-                        break
-                else:
-                    r.append(n)
-        return r
-
+            # Match against tags in query, smallest candidate set first
+            matches = sorted((index.prefix(q) for q in tags), key=len)
+            paths = set.intersection(*matches)
+            # Skip notes tagged with ARCHIVED unless ARCHIVED is part of query
+            if defs.ARCHIVED not in tags:
+                paths = paths - index.archived
+        return [self._files[p] for p in paths]
+
+    @reader
     def filter(self, query):
         r = self._filter(query)
         return [n._asdict() for n in r]
 
     def _search(self, query):
         # Body text search using regexp
-        query_re = re.compile(query, re.IGNORECASE)
-        r = [n for n in self._notes if query_re.search(n.body)]
+        query_re = search_regex(query)
+        paths = self._candidates(query_re.pattern) if self._text_index else None
+        notes = self._notes if paths is None else [self._files[p] for p in paths]
+        r = [n for n in notes if query_re.search(self._text(n, defs.BODY))]
         return r
 
+    def _candidates(self, pattern):
+        paths = self._text_index.candidates(pattern)
+        # Notes the index couldn't read, see _text
+        for notepath in self._text_index.take_unreadable():
+            self._add_pending(notepath)
+        return paths
+
+    def _text(self, note, field):
+        # Lazy bodies are read from file, a note removed or broken since the
+        # last refresh doesn't match and is queued to be picked up by the next
+        try:
+            return getattr(note, field)
+        except (OSError, MalformedNote):
+            self._add_pending(note.path)
+            return ""
+
+    @reader
     def search(self, query):
         # Body text search using regexp
         r = self._search(query)
         return [n._asdict() for n in r]
 
+    # Link graph, IDs of existing notes only
+
+    @reader
+    def backlinks(self, note_id):
+        # IDs of notes linking to note_id
+        return sorted(i for i in self._link_graph.incoming(note_id) if i in self._paths)
+
+    @reader
+    def links(self, note_id):
+        # IDs of notes linked from note_id
+        return sorted(i for i in self._link_graph.outgoing(note_id) if i in self._paths)
+
+    @reader
+    def orphans(self):
+        # IDs of notes without links to or from other notes
+        return sorted(self._link_graph.orphans(self._paths))
+
+    @reader
+    def neighbourhood(self, note_id, hops=1, direction="both"):
+        # {ID: distance} of notes at most hops links away from note_id,
+        # following links "out", "in" or in "both" directions
+        if note_id not in self._paths:
+            return {}
+        return self._link_graph.neighbourhood(note_id, hops, direction, self._paths)
+
+    @reader
+    def related(self, note_id=None, text=None, k=10):
+        # Up to k notes (headers only) most similar to note_id, or to text,
+        # best first (archived notes left out), see related.py
+        key = None
+        if note_id is not None:
+            key = self._paths.get(note_id)
+            if key is None:
+                return []
+        with metrics.timer("related"):
+            hits = self._related.similar(key, text, k, exclude=self._tag_index.archived)
+        return [self._files[p]._asdict(body=False) for p, _ in hits]
+
+    @reader
     def filepath(self, note_id):
-        for n in self._notes:
-            if n.id == note_id:
-                return n.filepath(self.zkdir)
-
+        return self._paths.get(note_id)
 
     def _note(self, note_id):
-        for n in self._notes:
-            if n.id == note_id:
-                return n
+        notepath = self._paths.get(note_id)
+        return self._files[notepath] if notepath else None
 
     #
     # API
     #
 
     # Called by server
+    # Cheap when nothing changed, costs a single directory scan
     def rebuild_db(self):
-        self._notes = []
-        self._maybe_init_db()
-        self.load_notes(self.zkdir)
+        self._take_pending()
+        self.update_notes(self.zkdir)
+        if not self._files and self._maybe_init_db():
+            self.update_notes(self.zkdir)
+
+    def refresh(self):
+        # Apply changes to notes reported by background tasks (closed editors, watcher)
+        # A pending None means that a full directory scan is needed
+        if self._lock.reading():
+            # Can't write while reading, leave it for the next call
+            return
+        pending = self._take_pending()
+        if None in pending:
+            self.update_notes(self.zkdir)
+        elif pending:
+            self.update_notes(self.zkdir, pending)
+
+    def watch(self, **kwargs):
+        # Keep the database live by watching the notes directory for changes
+        if self._watcher is None:
+            self._watcher = Watcher(self, **kwargs).start()
+        return self._watcher
+
+    def unwatch(self):
+        if self._watcher is not None:
+            self._watcher.stop()
+            self._watcher = None
+
+    @property
+    def watching(self):
+        return self._watcher is not None
+
+    def _take_pending(self):
+        with self._pending_lock:
+            pending, self._pending = self._pending, set()
+        return pending
+
+    def _add_pending(self, notepath):
+        with self._pending_lock:
+            self._pending.add(notepath)
+
+    # Called by server
+    def query(self, query_string, sort_key=defs.DATE, reverse=True, offset=0, limit=None):
+        return self.query_page(query_string, sort_key, reverse, offset, limit)[1]
 
     # Called by server
-    def query(self, query_string, sort_key=defs.DATE, reverse=True):
-        self.sort_key = sort_key
-        self.sort_reversed = reverse
-        notes = self.execute_query(query_string)
-        return [n._asdict() for n in sorted(notes, key=self._sort_fn, reverse=self.sort_reversed)]
+    # Returns (total number of matches, notes[offset:offset+limit])
+    # The notes are headers only (no body, see note()), a page of notes
+    # shouldn't read a file per note when bodies are lazy
+    def query_page(self, query_string, sort_key=defs.DATE, reverse=True, offset=0, limit=None):
+        self.refresh()
+        with self._lock.read():
+            field = self._sort_field(sort_key)
+            key = (query_string, field, reverse, self._generation)
+            result = self._memo.get(key)
+            if result is None:
+                with metrics.timer("query"):
+                    result = QueryResult(self._execute_query(query_string))
+                self._memo.put(key, result)
+            else:
+                metrics.count("query_memo_hits")
+            end = None if limit is None else offset + limit
+            page = result.page(offset, end)
+            if page is None:
+                with metrics.timer("sort"):
+                    ordered = self._order(result.paths, self._sort_indexes[field], reverse, end)
+                result.ordered = (ordered, end is None or end >= len(result.paths))
+                page = ordered[offset:end]
+            metrics.count("query_matches", len(result.paths))
+            return (len(result.paths), [self._files[p]._asdict(body=False) for p in page])
+
+    def _order(self, paths, index, reverse, end=None):
+        # The first end (None: all) paths in index order
+        if len(paths) * SORT_WALK_RATIO >= len(self._files):
+            # Large result, walk the presorted index and stop after the page
+            return list(islice(index.ordered(paths, reverse), end))
+        if end is None:
+            return sorted(paths, key=index.sort_key, reverse=reverse)
+        # Top-k selection, only the requested pages need to be ordered
+        select = heapq.nlargest if reverse else heapq.nsmallest
+        return select(end, paths, key=index.sort_key)
 
     # Called by server
     def note(self, note_id):
-        return self._note(note_id)._asdict()
+        self.refresh()
+        with self._lock.read():
+            return self._note(note_id)._asdict()
 
     # Called by server
     def tags(self, mincount, sort=True):
-        # Return all tags and corresponding occurence count
-        tags = {}
-        for n in self._notes:
-            if defs.ARCHIVED in n.tags:
-                continue
-            for t in n.tags:
-                tags[t] = tags.setdefault(t, 0) + 1
-        taglist = [t for t, c in tags.items() if c >= mincount]
+        # Return all tags occuring at least mincount times (archived notes excluded)
+        self.refresh()
+        with self._lock.read():
+            taglist = [t for t, c in self._tag_index.counts.items() if c >= mincount]
         tags = sorted(taglist) if sort else taglist
         return tags
 
     # Called by server
+    @writer
     def create(self, body=""):
         note = ZKNote()
+        # IDs are timestamps, a note created within a second of another one
+        # (e.g. the welcome note) gets the next free second
+        while self.filepath(note.id) or os.path.exists(note.filepath(self.zkdir)):
+            note.date += timedelta(seconds=1)
+            note.modified = note.date
+            note.id = note.date.strftime("%y%m%d%H%M%S")
         note.body = body
         note.write(self.zkdir)
-        # FIXME: Update should suffice...
-        self.load_notes(self.zkdir)
+        self.update_notes(self.zkdir, [note.filepath(self.zkdir)])
         return note.id
 
     # Called by server
-    def edit(self, note_id):
+    # Launches the editor and returns immediately, the note is refreshed
+    # once the editor exits. Pass wait=True to block until then.
+    def edit(self, note_id, wait=False):
         filepath = self.filepath(note_id)
-        editor_cmd = f'{config.conf["editor"]} "{filepath}"'
-        subprocess.run(editor_cmd, shell=True)
+        editor_cmd = f'{conf["editor"]} "{filepath}"'
+        if wait:
+            subprocess.run(editor_cmd, shell=True)
+            self.update_notes(self.zkdir, [filepath])
+            return
+        proc = subprocess.Popen(
+            editor_cmd, shell=True, start_new_session=True,
+            stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+        )
+        threading.Thread(target=self._editor_done, args=(proc, filepath), daemon=True).start()
+        return proc
+
+    def _editor_done(self, proc, filepath):
+        proc.wait()
+        self._add_pending(filepath)
+
+    # Maintenance, see batch.Batch
+    # Pass dry_run=True to get the list of changes without making them
+
+    def batch(self, workers=None):
+        return Batch(self, workers)
+
+    # The notes are brought up to date first, files changed on disk since are
+    # re-read rather than overwritten (see also Batch._check_unchanged)
 
     # Called by server
-    def archive(self, note_id):
-        filepath = self.filepath(note_id)
-        note = ZKNote(filepath)
+    @writer
+    def archive(self, note_id, dry_run=False):
+        notepath = self.filepath(note_id)
+        if notepath:
+            self.update_notes(self.zkdir, [notepath])
+        batch = Batch(self)
+        note = editable(self._note(note_id))
         note.toggle_archived()
-        note.write(self.zkdir)
-
-    def purge_empty_archived(self):
-        notes = self.execute_query(defs.ARCHIVED)
-        purged = []
-        for n in notes:
-            if n.body.strip() == "":
-                filepath = self.filepath(n.id)
-                if os.path.exists(filepath):
-                    purged.append(f"purging: {filepath}")
-                    os.remove(filepath)
-        return purged
-
-    def rename_tag(self, old_name, new_name):
-        for n in self._notes:
-            tag = n.rename_tag(old_name, new_name)
-            if tag:
-                n.write(self.zkdir)
+        batch.write(note)
+        return batch.commit(dry_run)
+
+    @writer
+    def purge_empty_archived(self, dry_run=False):
+        self._take_pending()
+        self.update_notes(self.zkdir)
+        batch = Batch(self)
+        for notepath in sorted(self._tag_index.archived):
+            if self._files[notepath].body.strip() == "":
+                batch.remove(notepath)
+        return batch.commit(dry_run)
+
+    @writer
+    def rename_tag(self, old_name, new_name, dry_run=False):
+        self._take_pending()
+        self.update_notes(self.zkdir)
+        batch = Batch(self)
+        for notepath in sorted(self._tag_index.tagged(old_name)):
+            note = editable(self._files[notepath])
+            if note.rename_tag(old_name, new_name):
+                batch.write(note)
+        return batch.commit(dry_run)
 
 if __name__ == "__main__":
     import sys
@@ -1,13 +1,180 @@
 import os
 import re
 import pwd
+import codecs
+from functools import lru_cache
 from datetime import datetime
 
 from . import definitions as defs
+from .config import conf
 
 
 re_header_entry = re.compile(defs.HEADER_LINE_REGEX)
 re_anfang = re.compile(defs.ANFANG_REGEX)
+re_zk_link = re.compile(defs.ZK_LINK_REGEX)
+# A line consisting of "---" (and whitespace)
+re_header_delimiter = re.compile(r"^[^\S\n]*---[^\S\n]*$", re.MULTILINE)
+# All entries of a header block at once, same as HEADER_LINE_REGEX on each stripped line
+re_header_entries = re.compile(r"^[^\S\n]*([a-zA-Z][a-zA-Z0-9_]*):[^\S\n]*(.*?)[^\S\n]*$", re.MULTILINE)
+
+# Amount of body text read by a header-only parse to derive a missing title
+TITLE_PREFIX_SIZE = 4096
+# Bytes initially read by a header-only parse, more is read if needed
+HEADER_READ_SIZE = 16 * 1024
+
+# Directory layouts, see note_path
+LAYOUTS = ("flat", "sharded")
+
+
+class MalformedNote(ValueError):
+    """Raised when a file can't be parsed as a note (e.g. has no header)"""
+
+
+@lru_cache(maxsize=None)
+def default_author():
+    return pwd.getpwuid(os.getuid())[4]
+
+
+@lru_cache(maxsize=4096)
+def parse_datetime(value):
+    # Most notes have Date == Modified, and datetimes are immutable
+    return datetime.fromisoformat(value)
+
+
+def parse_tags(value):
+    return [t.strip(" ,") for t in value.split()]
+
+
+# Parsers for header values, by lowercase key
+HEADER_PARSERS = {
+    defs.DATE: parse_datetime,
+    defs.MODIFIED: parse_datetime,
+    defs.ID: str,
+    defs.AUTHOR: str,
+    defs.TAGS: parse_tags,
+    defs.TITLE: str,
+}
+
+
+def decode(data, final=True):
+    # Decode file contents like reading the file in text mode (universal newlines).
+    # With final=False an incomplete character at the end is left out.
+    text = codecs.getincrementaldecoder("utf-8")().decode(data, final)
+    if "\r" in text:
+        text = text.replace("\r\n", "\n").replace("\r", "\n")
+    return text
+
+
+def note_path(zkdir, note_id, layout=None):
+    """
+    Path of the file for a note in zkdir, computed from the ID alone.
+
+    Args:
+        zkdir (str): Base directory for Zettelkasten notes.
+        note_id (str): ID of the note (yymmddHHMMSS).
+        layout (str, optional): "flat" (zkdir/zk<ID>.md) or "sharded"
+            (zkdir/yy/mm/zk<ID>.md). Defaults to the layout setting.
+
+    Returns:
+        str: Full path to the note file.
+    """
+    layout = conf["layout"] if layout is None else layout
+    filename = f"zk{note_id}.md"
+    if layout == "sharded":
+        return os.path.join(zkdir, note_id[0:2], note_id[2:4], filename)
+    return os.path.join(zkdir, filename)
+
+
+def scan_note_files(zkdir, workers=None):
+    """
+    Find the note files (zk<ID>.md) in zkdir and its yy/mm shard directories.
+
+    Notes are found whatever the layout (or mix of layouts). Other
+    subdirectories (backups, exports, images, ...) are left alone.
+    Shards are scanned in parallel.
+
+    Args:
+        zkdir (str): Base directory for Zettelkasten notes.
+        workers (int, optional): Max number of shards scanned in parallel.
+            Defaults to the load_workers setting.
+
+    Returns:
+        dict: {notepath: (mtime_ns, size)}
+    """
+    workers = conf["load_workers"] if workers is None else workers
+    stats = {}
+    shards = _scan_dir(zkdir, stats)
+    if workers > 1 and len(shards) > 1:
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(max_workers=min(workers, len(shards))) as pool:
+            for shard_stats in pool.map(_scan_tree, shards):
+                stats.update(shard_stats)
+    else:
+        for shard in shards:
+            stats.update(_scan_tree(shard))
+    return stats
+
+
+def is_shard(name):
+    # Directory names of the sharded layout (yy and mm, see note_path)
+    return len(name) == 2 and name.isdigit()
+
+
+def _scan_tree(path):
+    # All notes in a yy shard
+    stats = {}
+    for subdir in _scan_dir(path, stats):
+        _scan_dir(subdir, stats)
+    return stats
+
+
+def _scan_dir(path, stats):
+    # Adds the note files in path to stats, returns the shard subdirectories
+    subdirs = []
+    try:
+        entries = os.scandir(path)
+    except (FileNotFoundError, NotADirectoryError):
+        # Removed during the scan
+        return subdirs
+    with entries:
+        for entry in entries:
+            (name, ext) = os.path.splitext(entry.name)
+            if ext != ".md" or not name.startswith("zk"):
+                try:
+                    if is_shard(entry.name) and entry.is_dir(follow_symlinks=False):
+                        subdirs.append(entry.path)
+                except OSError:
+                    pass
+                continue
+            try:
+                st = entry.stat()
+            except FileNotFoundError:
+                continue
+            stats[entry.path] = (st.st_mtime_ns, st.st_size)
+    return subdirs
+
+
+def split_note(text):
+    """
+    Locate the header of a note.
+
+    The header is made up of the lines between the first two lines
+    consisting of "---", anything before it is skipped.
+
+    Args:
+        text (str): Contents of a note file.
+
+    Returns:
+        tuple: (header block, index in text where the body starts)
+
+    Raises:
+        MalformedNote: If the header is missing or not terminated.
+    """
+    start = re_header_delimiter.search(text)
+    end = re_header_delimiter.search(text, start.end()) if start else None
+    if end is None:
+        raise MalformedNote("No header delimited by '---' lines")
+    return (text[start.end() + 1:end.start()], min(end.end() + 1, len(text)))
 
 
 class ZKNote(object):
@@ -18,30 +185,50 @@ class ZKNote(object):
     from a Zettelkasten system. Notes are stored as markdown files with
     YAML-style metadata headers.
 
+    Notes use __slots__ to keep per-note memory low. The body of a note
+    read from file can be dropped from memory (see unload_body) and is
+    then re-read from the file when accessed.
+
     Attributes:
-        data (dict): Dictionary containing all note metadata and content.
         id (str): Unique identifier for the note, derived from the date.
         date (datetime): Creation date of the note.
         modified (datetime): Last modified date (defaults to creation date).
         author (str): Author of the note, derived from system information.
         tags (list): List of tags associated with the note.
         title (str): Title of the note, extracted from the body or header.
-        body (str): Main content of the note.
+        body (str): Main content of the note, loaded on demand.
         backlinks (list): List of backlinks to this note (set via set_backlinks).
     """
 
-    def __init__(self, filepath=None):
+    __slots__ = (
+        defs.DATE, defs.MODIFIED, defs.ID, defs.AUTHOR, defs.TAGS, defs.TITLE,
+        "backlinks", "_body", "_path",
+    )
+
+    def __init__(self, filepath=None, data=None, header_only=False):
         """
         Initialize a ZKNote instance.
 
         Args:
             filepath (str, optional): Path to the note file. If provided,
                 the note is read from this file. Defaults to None.
+            data (dict, optional): Already parsed and validated note data,
+                e.g. from the note cache. Defaults to None.
+            header_only (bool, optional): Only parse the header of filepath,
+                the body is read from file when accessed. Defaults to False.
         """
         super(ZKNote, self).__init__()
-        self.data = {}
-        if filepath:
-            self.read(filepath)
+        for key in defs.HEADER_KEYS:
+            setattr(self, key, None)
+        self.backlinks = []
+        self._body = None
+        self._path = filepath
+        if data is not None:
+            for key in defs.HEADER_KEYS:
+                setattr(self, key, data[key])
+            self._body = data[defs.BODY]
+        elif filepath:
+            self.read(filepath, header_only)
         else:
             self.validate()
 
@@ -67,26 +254,39 @@ Title: {self.title}
 ---
 {self.body}"""
 
-    def __getattr__(self, name):
+    @property
+    def body(self):
+        """The note's body, read from the note's file if not in memory."""
+        if self._body is not None:
+            return self._body
+        if self._path is None:
+            return ""
+        with open(self._path, "rb") as fd:
+            text = decode(fd.read())
+        return text[split_note(text)[1]:]
+
+    @body.setter
+    def body(self, text):
+        self._body = text
+
+    def unload_body(self):
+        """Drop the body from memory if it can be re-read from file."""
+        if self._path is not None:
+            self._body = None
+
+    def _asdict(self, body=True):
         """
-        Handle attribute access for note metadata.
-
-        Delegates attribute access to the internal data dictionary.
-        If the attribute is not in the predefined keys, raises an error.
+        Return the note's data as a dictionary.
 
         Args:
-            name (str): Attribute name to access.
-
-        Raises:
-            AttributeError: If the attribute is not recognized.
+            body (bool, optional): Include the body, which may have to be
+                read from file. Leave it out for lists of notes. Defaults to True.
         """
-        if name not in defs.ALL_KEYS:
-            raise AttributeError("ZKNote has no attribute '{}'".format(name))
-        return self.data[name]
-
-    def _asdict(self):
-        """Return the note's data as a dictionary."""
-        return self.data
+        data = {key: getattr(self, key) for key in defs.HEADER_KEYS}
+        if body:
+            data[defs.BODY] = self.body
+        data["backlinks"] = self.backlinks
+        return data
 
     def set_backlinks(self, links):
         """
@@ -95,29 +295,72 @@ Title: {self.title}
         Args:
             links (list): List of note IDs that reference this note.
         """
-        self.data["backlinks"] = links
+        self.backlinks = links
+
+    def links(self):
+        """Return the set of IDs of the notes linked to (zk://<ID>) from the body."""
+        return {m[len("zk://"):] for m in re_zk_link.findall(self.body)}
+
+    @property
+    def path(self):
+        """Path of the file the note was read from, None if not read from file."""
+        return self._path
 
-    def filepath(self, zkdir):
+    def filepath(self, zkdir, layout=None):
         """
         Generate the file path for this note.
 
         Args:
             zkdir (str): Base directory for Zettelkasten notes.
+            layout (str, optional): See note_path. Defaults to the layout setting.
 
         Returns:
             str: Full path to the note file.
         """
-        return os.path.join(os.path.expanduser(zkdir), f"zk{self.id}.md")
+        return note_path(os.path.expanduser(zkdir), self.id, layout)
 
-    def read(self, filepath):
+    def read(self, filepath, header_only=False):
         """
         Read and parse a note from a file.
 
+        The file is read in one go (header_only: just its start, unless
+        that doesn't cover the header and the text needed for the title).
+
         Args:
             filepath (str): Path to the note file.
+            header_only (bool, optional): Stop reading after the header.
+
+        Raises:
+            MalformedNote: If the file isn't a valid note.
         """
-        with open(filepath, "r", encoding="utf-8") as fd:
-            self.parse(fd)
+        self._path = filepath
+        with open(filepath, "rb") as fd:
+            if not header_only:
+                self.parse_text(decode(fd.read()))
+                return
+            data = fd.read(HEADER_READ_SIZE)
+            if len(data) == HEADER_READ_SIZE:
+                text = decode(data, final=False)
+                try:
+                    (header, start) = split_note(text)
+                except MalformedNote:
+                    header = None
+                if header is not None and (
+                    self._has_title(header) or len(text) - start > TITLE_PREFIX_SIZE
+                ):
+                    self.parse_text(text, header_only, (header, start))
+                    return
+                data += fd.read()
+            self.parse_text(decode(data), header_only)
+
+    @staticmethod
+    def _has_title(header):
+        # True if the header block sets a non-empty title
+        title = ""
+        for (key, value) in re_header_entries.findall(header):
+            if key.lower() == defs.TITLE:
+                title = value
+        return bool(title)
 
     def write(self, zkdir):
         """
@@ -127,21 +370,44 @@ Title: {self.title}
             zkdir (str): Base directory for Zettelkasten notes.
         """
         filepath = self.filepath(zkdir)
+        os.makedirs(os.path.dirname(filepath), exist_ok=True)
         with open(filepath, "w", encoding="utf-8") as fd:
             print(self, file=fd, end="")
 
-    def parse(self, file):
+    def parse(self, file, header_only=False):
         """
         Parse the note's header and body from a file.
 
         Args:
-            file: File object containing the note content.
+            file: File object (opened in text mode) containing the note content.
+            header_only (bool, optional): Leave the body unread, except for
+                the start of it if needed for a missing title.
         """
-        self.parse_header(file)
-        self.parse_body(file)
-        self.validate()
+        self.parse_text(file.read(), header_only)
 
-    def validate(self):
+    def parse_text(self, text, header_only=False, split=None):
+        """
+        Parse the note's header and body from the contents of a note file.
+
+        Args:
+            text (str): Note file contents, with newlines normalized to \\n.
+            header_only (bool, optional): See parse.
+            split (tuple, optional): The result of split_note(text), if known.
+
+        Raises:
+            MalformedNote: If text isn't a valid note.
+        """
+        (header, start) = split or split_note(text)
+        self.parse_header_block(header)
+        if not header_only:
+            self._body = text[start:]
+            self.validate()
+        elif self.title:
+            self.validate()
+        else:
+            self.validate(body_prefix=text[start:start + TITLE_PREFIX_SIZE])
+
+    def validate(self, body_prefix=None):
         """
         Validate and set default values for note metadata.
 
@@ -151,17 +417,28 @@ Title: {self.title}
         - MODIFIED: Same as DATE
         - TAGS: Empty list
         - AUTHOR: Current user
-        - BODY: Empty string
-        """
-        self.data.setdefault(defs.DATE, datetime.now())
-        self.data.setdefault(defs.ID, self.data[defs.DATE].strftime("%y%m%d%H%M%S"))
-        self.data.setdefault(defs.MODIFIED, self.data[defs.DATE])
-        self.data.setdefault(defs.TAGS, [])
-        self.data.setdefault(defs.AUTHOR, pwd.getpwuid(os.getuid())[4])
-        self.data.setdefault(defs.BODY, "")
-        if not self.data.get(defs.TITLE):
-            match = re_anfang.match(self.data[defs.BODY])
-            self.data[defs.TITLE] = match.group(1) if match else ""
+        - BODY: Empty string (unless it can be read from file)
+
+        Args:
+            body_prefix (str, optional): Start of the body, used to derive
+                the title when the body isn't loaded.
+        """
+        if self.date is None:
+            self.date = datetime.now()
+        if self.id is None:
+            self.id = self.date.strftime("%y%m%d%H%M%S")
+        if self.modified is None:
+            self.modified = self.date
+        if self.tags is None:
+            self.tags = []
+        if self.author is None:
+            self.author = default_author()
+        if self._body is None and self._path is None:
+            self._body = ""
+        if not self.title:
+            text = self._body if body_prefix is None else body_prefix
+            match = re_anfang.match(text or "")
+            self.title = match.group(1) if match else ""
 
     def parse_body(self, file):
         """
@@ -170,32 +447,67 @@ Title: {self.title}
         Args:
             file: File object containing the note content.
         """
-        self.data[defs.BODY] = file.read()
+        self._body = file.read()
 
-    def parse_header(self, file):
+    @staticmethod
+    def header_lines(file):
         """
-        Parse the metadata header from the note.
-
-        Processes lines between --- delimiters, extracting key-value pairs
-        using the HEADER_LINE_REGEX pattern.
+        Yield the (stripped) lines between the --- delimiters, leaving
+        the file positioned at the start of the body.
 
         Args:
             file: File object containing the note content.
+
+        Raises:
+            MalformedNote: If the file ends before the end of the header.
         """
         # Skip initial lines
         header_tag = "---"
         line = ""
         while line != header_tag:
-            line = file.readline().strip()
+            line = file.readline()
+            if not line:
+                raise MalformedNote("No header delimited by '---' lines")
+            line = line.strip()
 
         while True:
             line = file.readline()
+            if not line:
+                raise MalformedNote("Header not terminated by '---'")
             line = line.strip()
             if line == header_tag:
                 break
-            match = re_header_entry.match(line)
-            if match:
-                self.parse_entry(key=match.group(1), value=match.group(2))
+            yield line
+
+    def parse_header(self, file):
+        """
+        Parse the metadata header from the note.
+
+        Processes lines between --- delimiters, extracting key-value pairs
+        using the HEADER_LINE_REGEX pattern.
+
+        Args:
+            file: File object containing the note content.
+        """
+        self.parse_header_block("\n".join(self.header_lines(file)))
+
+    def parse_header_block(self, header):
+        """
+        Parse the "Key: value" entries of a header.
+
+        Equivalent to matching each (stripped) line with HEADER_LINE_REGEX
+        and passing the matches to parse_entry, but in a single pass.
+        Unknown keys and lines that aren't entries are ignored.
+
+        Args:
+            header (str): The lines between the --- delimiters.
+        """
+        parsers = HEADER_PARSERS
+        for (key, value) in re_header_entries.findall(header):
+            key = key.lower()
+            parser = parsers.get(key)
+            if parser is not None:
+                setattr(self, key, parser(value))
 
     def parse_entry(self, key, value):
         """
@@ -206,15 +518,9 @@ Title: {self.title}
             value (str): Header value.
         """
         key = key.lower()
-        if key not in defs.HEADER_KEYS:
-            return
-        if key in [defs.DATE, defs.MODIFIED]:
-            self.data[key] = datetime.fromisoformat(value)
-            return
-        if key == defs.TAGS:
-            self.data[key] = [t.strip(" ,") for t in value.split()]
-            return
-        self.data[key] = value
+        parser = HEADER_PARSERS.get(key)
+        if parser is not None:
+            setattr(self, key, parser(value))
 
     def toggle_archived(self):
         """
@@ -238,4 +544,3 @@ Title: {self.title}
             self.tags.remove(old_name)
             self.tags.append(new_name)
             return new_name
-
@@ -1,3 +1,11 @@
 from .ZKNote import ZKNote
-from .ZKDatabase import ZK
 from .config import conf as config
+
+
+def __getattr__(name):
+    # The database is imported on first use, so that e.g. the zk tool can
+    # create a note without loading the query and indexing machinery
+    if name == "ZK":
+        from .ZKDatabase import ZK
+        return ZK
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
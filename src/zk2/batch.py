@@ -0,0 +1,144 @@
+import os
+import copy
+import uuid
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+from .config import conf
+
+#
+# Batched changes to note files, for collection wide maintenance
+# (renaming tags, purging notes, ...).
+#
+# Changes are collected first and written on commit(): every file is
+# replaced atomically, files are written in parallel (bounded by
+# load_workers) and the database takes in the written notes in one go
+# afterwards, without re-reading them. A file that changed on disk since
+# the database read it is left alone (ChangedOnDisk), so that edits made
+# meanwhile aren't overwritten.
+#
+
+WRITE = "write"
+REMOVE = "remove"
+
+# Outcome of (or, for a dry run, plan for) a change to one file, error is
+# None on success
+Result = namedtuple("Result", ["action", "path", "error"])
+
+
+class ChangedOnDisk(OSError):
+    pass
+
+
+def atomic_write(filepath, text):
+    # Write to a temp file next to filepath and rename it into place, so that
+    # editors, the watcher or other processes never see a partially written note.
+    # The temp name doesn't look like a note file (see watcher.is_note_file).
+    (dirname, filename) = os.path.split(filepath)
+    tmppath = os.path.join(dirname, f".{filename}.{uuid.uuid4().hex[:8]}.tmp")
+    try:
+        with open(tmppath, "x", encoding="utf-8") as fd:
+            fd.write(text)
+        os.replace(tmppath, filepath)
+    except BaseException:
+        try:
+            os.remove(tmppath)
+        except OSError:
+            pass
+        raise
+
+
+def editable(note):
+    # Copy of note that can be changed and passed to Batch.write, the note
+    # in the database is left untouched until the batch is committed
+    edited = copy.copy(note)
+    edited.tags = list(note.tags)
+    edited.body = note.body
+    return edited
+
+
+class Batch(object):
+    """
+    Changes to note files, carried out together by commit().
+
+    Args:
+        zk (ZK): Database the notes belong to.
+        workers (int, optional): Max number of files written in parallel.
+            Defaults to the load_workers setting.
+    """
+
+    def __init__(self, zk, workers=None):
+        super(Batch, self).__init__()
+        self.zk = zk
+        self.workers = conf["load_workers"] if workers is None else workers
+        self._writes = {}
+        self._removes = []
+
+    def __len__(self):
+        return len(self._writes) + len(self._removes)
+
+    def write(self, note):
+        # (Re)write note to its file, see editable()
+        # Notes stay where they are, whatever the layout setting
+        self._writes[note.path or note.filepath(self.zk.zkdir)] = note
+
+    def remove(self, notepath):
+        self._removes.append(notepath)
+
+    def plan(self):
+        # The changes commit() would make, as a list of Results
+        return (
+            [Result(WRITE, p, None) for p in self._writes]
+            + [Result(REMOVE, p, None) for p in self._removes]
+        )
+
+    def commit(self, dry_run=False):
+        """
+        Write the changes to disk and update the database.
+
+        Args:
+            dry_run (bool, optional): Only return the plan, change nothing.
+
+        Returns:
+            list: A Result per changed file. Failed changes have the
+                exception as error, the rest of the batch is still applied.
+        """
+        plan = self.plan()
+        if dry_run or not plan:
+            return plan
+        if self.workers > 1 and len(plan) > 1:
+            with ThreadPoolExecutor(max_workers=min(self.workers, len(plan))) as pool:
+                results = list(pool.map(self._execute, plan))
+        else:
+            results = [self._execute(step) for step in plan]
+        written = {r.path: self._writes[r.path] for r in results if r.action == WRITE and r.error is None}
+        # Includes failed removals, the database checks what's really gone
+        removed = [r.path for r in results if r.action == REMOVE]
+        self._writes = {}
+        self._removes = []
+        self.zk._apply_batch(written, removed)
+        return results
+
+    def _execute(self, step):
+        try:
+            self._check_unchanged(step.path)
+            if step.action == WRITE:
+                atomic_write(step.path, str(self._writes[step.path]))
+            else:
+                os.remove(step.path)
+        except OSError as err:
+            return step._replace(error=err)
+        return step
+
+    def _check_unchanged(self, notepath):
+        # Raises ChangedOnDisk if notepath isn't the file the database read
+        expected = self.zk._stats.get(notepath)
+        if expected is None:
+            # New file
+            return
+        try:
+            st = os.stat(notepath)
+        except FileNotFoundError:
+            raise ChangedOnDisk(f"{notepath} was removed")
+        if (st.st_mtime_ns, st.st_size) != expected:
+            raise ChangedOnDisk(f"{notepath} changed on disk")
@@ -0,0 +1,204 @@
+import os
+import json
+import sqlite3
+from datetime import datetime
+from collections import Counter
+
+from . import definitions as defs
+
+# On-disk snapshot of parsed notes, stored next to the notes as an SQLite db.
+# Rows are keyed by the note's path relative to the notes dir and are only
+# trusted if the file's (mtime_ns, size) still matches.
+# Bump CACHE_VERSION whenever the schema or the parsed representation changes.
+
+CACHE_FILE = ".zk2cache.sqlite"
+CACHE_VERSION = 1
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS notes (
+    path TEXT PRIMARY KEY,
+    mtime_ns INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    id TEXT NOT NULL,
+    date TEXT NOT NULL,
+    modified TEXT NOT NULL,
+    author TEXT NOT NULL,
+    tags TEXT NOT NULL,
+    title TEXT NOT NULL,
+    body TEXT NOT NULL,
+    links TEXT NOT NULL
+)
+"""
+
+_COLUMNS = "path, mtime_ns, size, id, date, modified, author, tags, title, body, links"
+
+# Max number of host parameters in one statement (SQLITE_MAX_VARIABLE_NUMBER)
+_CHUNK = 500
+
+
+class NoteCache(object):
+    """
+    Persistent cache of parsed notes for a notes directory.
+
+    All errors from the underlying database are swallowed; a broken or
+    unwritable cache behaves like an empty one.
+    """
+
+    def __init__(self, zkdir):
+        super(NoteCache, self).__init__()
+        self.zkdir = zkdir
+        self.path = os.path.join(zkdir, CACHE_FILE)
+        self._prefix = os.path.join(zkdir, "")
+
+    def _connect(self):
+        db = sqlite3.connect(self.path, timeout=10)
+        # WAL lets several server processes read while one of them writes
+        db.execute("PRAGMA journal_mode=WAL")
+        version = db.execute("PRAGMA user_version").fetchone()[0]
+        if version != CACHE_VERSION:
+            db.execute("DROP TABLE IF EXISTS notes")
+            db.execute(_SCHEMA)
+            db.execute(f"PRAGMA user_version = {CACHE_VERSION}")
+            db.commit()
+        return db
+
+    def _relpath(self, notepath):
+        # Paths from scanning zkdir all start with it, os.path.relpath is slow
+        if notepath.startswith(self._prefix):
+            return notepath[len(self._prefix):]
+        return os.path.relpath(notepath, self.zkdir)
+
+    def load(self, stats):
+        """
+        Look up cached notes.
+
+        Args:
+            stats (dict): {notepath: (mtime_ns, size)} of the wanted notes.
+
+        Returns:
+            dict: {notepath: (data, links)} for notes with a valid cache entry,
+                where data is a complete ZKNote data dict and links a set of IDs.
+        """
+        wanted = {self._relpath(p): (p, s) for p, s in stats.items()}
+        if not wanted or not os.path.exists(self.path):
+            return {}
+        found = {}
+        try:
+            db = self._connect()
+            try:
+                if len(wanted) > _CHUNK:
+                    rows = db.execute(f"SELECT {_COLUMNS} FROM notes")
+                    self._collect(rows, wanted, found)
+                else:
+                    keys = list(wanted)
+                    for i in range(0, len(keys), _CHUNK):
+                        chunk = keys[i:i + _CHUNK]
+                        marks = ",".join("?" * len(chunk))
+                        rows = db.execute(f"SELECT {_COLUMNS} FROM notes WHERE path IN ({marks})", chunk)
+                        self._collect(rows, wanted, found)
+            finally:
+                db.close()
+        except sqlite3.Error:
+            return {}
+        return found
+
+    def move(self, moves):
+        """
+        Keep the entries of notes that were moved (renamed keeps mtime and size).
+
+        Args:
+            moves (list): (old notepath, new notepath) tuples.
+        """
+        if not moves or not os.path.exists(self.path):
+            return
+        rows = [(self._relpath(new), self._relpath(old)) for old, new in moves]
+        try:
+            db = self._connect()
+            try:
+                with db:
+                    db.executemany("UPDATE OR REPLACE notes SET path = ? WHERE path = ?", rows)
+            finally:
+                db.close()
+        except sqlite3.Error:
+            pass
+
+    def tag_counts(self, stats):
+        """
+        Count tags without loading the notes, see ZK.tags.
+
+        Args:
+            stats (dict): {notepath: (mtime_ns, size)} of all notes.
+
+        Returns:
+            Counter: {tag: number of notes} (archived notes not counted), or
+                None unless every note has a valid cache entry.
+        """
+        wanted = {self._relpath(p): s for p, s in stats.items()}
+        if not os.path.exists(self.path):
+            return None
+        counts = Counter()
+        try:
+            db = self._connect()
+            try:
+                for (relpath, mtime_ns, size, tags) in db.execute("SELECT path, mtime_ns, size, tags FROM notes"):
+                    stat = wanted.pop(relpath, None)
+                    if stat is None:
+                        # Note since removed
+                        continue
+                    if stat != (mtime_ns, size):
+                        return None
+                    tags = json.loads(tags)
+                    if defs.ARCHIVED not in tags:
+                        counts.update(tags)
+            finally:
+                db.close()
+        except sqlite3.Error:
+            return None
+        return None if wanted else counts
+
+    def _collect(self, rows, wanted, found):
+        for (relpath, mtime_ns, size, note_id, date, modified, author, tags, title, body, links) in rows:
+            if relpath not in wanted:
+                continue
+            notepath, stat = wanted[relpath]
+            if stat != (mtime_ns, size):
+                continue
+            data = {
+                defs.DATE: datetime.fromisoformat(date),
+                defs.MODIFIED: datetime.fromisoformat(modified),
+                defs.ID: note_id,
+                defs.AUTHOR: author,
+                defs.TAGS: json.loads(tags),
+                defs.TITLE: title,
+                defs.BODY: body,
+            }
+            found[notepath] = (data, set(json.loads(links)))
+
+    def store(self, entries, removed=()):
+        """
+        Update the cache.
+
+        Args:
+            entries (list): (notepath, (mtime_ns, size), note, links) tuples.
+            removed (list): Paths of notes that no longer exist.
+        """
+        if not entries and not removed:
+            return
+        rows = [
+            (
+                self._relpath(notepath), stat[0], stat[1],
+                note.id, note.date.isoformat(), note.modified.isoformat(), note.author,
+                json.dumps(note.tags), note.title, note.body, json.dumps(sorted(links)),
+            )
+            for notepath, stat, note, links in entries
+        ]
+        try:
+            db = self._connect()
+            try:
+                with db:
+                    db.executemany("DELETE FROM notes WHERE path = ?", [(self._relpath(p),) for p in removed])
+                    db.executemany(f"INSERT OR REPLACE INTO notes ({_COLUMNS}) VALUES ({','.join('?' * 11)})", rows)
+            finally:
+                db.close()
+        except sqlite3.Error:
+            pass
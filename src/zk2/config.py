@@ -12,6 +12,17 @@ conf = {
     "notesdir": _conf.get("notesdir", "~/.zk"),
     "editor": _conf.get("editor", "open -e"),
     "md_cmd": _conf.get("md_cmd", ""),
+    "md_workers": _conf.get("md_workers", 2),
+    "md_timeout": _conf.get("md_timeout", 10),
+    "render_cache_size": _conf.get("render_cache_size", 16 * 1024 * 1024),
+    "cache": _conf.get("cache", True),
+    "search_index": _conf.get("search_index", False),
+    "watch": _conf.get("watch", True),
+    "watch_interval": _conf.get("watch_interval", 0),
+    "load_workers": _conf.get("load_workers", 8),
+    "lazy_bodies": _conf.get("lazy_bodies", False),
+    "metrics": _conf.get("metrics", False),
+    "layout": _conf.get("layout", "flat"),
 }
 
 if __name__ == '__main__':
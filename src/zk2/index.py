@@ -0,0 +1,426 @@
+import bisect
+import threading
+from array import array
+from collections import defaultdict, Counter
+
+from . import definitions as defs
+from .ZKNote import MalformedNote
+
+#
+# In-memory indexes over the note collection, keyed by note path.
+# Kept up to date by ZK._add_note/ZK._drop_note.
+#
+
+
+class TagIndex(object):
+    """
+    Inverted index from (lowercase) tag to notes.
+
+    Tag matching in queries is case insensitive and partial (prefix),
+    whereas tag counts are reported per tag as written in the notes.
+    Archived notes are indexed but not counted.
+    """
+
+    def __init__(self):
+        super(TagIndex, self).__init__()
+        self._postings = defaultdict(set)
+        self._sorted = None
+        self._tags = {}
+        self.counts = Counter()
+        self.archived = set()
+        self.untagged = set()
+
+    def add(self, key, tags):
+        tags = tuple(tags)
+        self._tags[key] = tags
+        if not tags:
+            self.untagged.add(key)
+            return
+        for tag in tags:
+            tag_lower = tag.lower()
+            if tag_lower not in self._postings and self._sorted is not None:
+                bisect.insort(self._sorted, tag_lower)
+            self._postings[tag_lower].add(key)
+        if defs.ARCHIVED in tags:
+            self.archived.add(key)
+        else:
+            self.counts.update(tags)
+
+    def remove(self, key):
+        tags = self._tags.pop(key, None)
+        if tags is None:
+            return
+        self.untagged.discard(key)
+        for tag in tags:
+            tag_lower = tag.lower()
+            notes = self._postings.get(tag_lower)
+            if notes is None:
+                continue
+            notes.discard(key)
+            if not notes:
+                del self._postings[tag_lower]
+                if self._sorted is not None:
+                    del self._sorted[bisect.bisect_left(self._sorted, tag_lower)]
+        if defs.ARCHIVED in tags:
+            self.archived.discard(key)
+        else:
+            self.counts.subtract(tags)
+            for tag in tags:
+                if self.counts[tag] <= 0:
+                    del self.counts[tag]
+
+    def tagged(self, tag):
+        # Notes tagged exactly (modulo case) with tag
+        return self._postings.get(tag.lower(), set())
+
+    def _prefixed(self, query):
+        # Lowercase tags starting with query
+        if self._sorted is None:
+            self._sorted = sorted(self._postings)
+        query = query.lower()
+        i = bisect.bisect_left(self._sorted, query)
+        while i < len(self._sorted) and self._sorted[i].startswith(query):
+            yield self._sorted[i]
+            i += 1
+
+    def prefix(self, query):
+        # Notes with any tag starting with query (case insensitive)
+        result = set()
+        for tag in self._prefixed(query):
+            result |= self._postings[tag]
+        return result
+
+    def prefix_size(self, query):
+        # Upper bound of len(self.prefix(query)), without building the set
+        return sum(len(self._postings[tag]) for tag in self._prefixed(query))
+
+    def match(self, key, query):
+        # True if the note has a tag starting with query (case insensitive)
+        query = query.lower()
+        return any(t.lower().startswith(query) for t in self._tags.get(key, ()))
+
+
+# Removed notes kept in the TextIndex postings before compacting, at least
+COMPACT_MIN = 256
+
+# Characters outside ASCII that re.IGNORECASE matches against ASCII letters
+_FOLD = {0x130: "i", 0x131: "i", 0x17f: "s", 0x212a: "k"}
+
+
+def fold(text):
+    # Case fold to ASCII bytes, one byte per character, all other characters become b"?"
+    return text.translate(_FOLD).lower().encode("ascii", "replace")
+
+
+def trigrams(text):
+    # Distinct trigrams of the folded text, as ints (the 3 bytes, big endian)
+    folded = fold(text)
+    return {(a << 16) | (b << 8) | c for a, b, c in set(zip(folded, folded[1:], folded[2:]))}
+
+
+def required_literals(pattern):
+    """
+    Extract literal substrings that any match of the regex pattern must contain.
+
+    Conservative: returns an empty list for patterns with alternation or
+    groups, and splits literals at anything that is not a plain character.
+    """
+    if "|" in pattern or "(" in pattern:
+        return []
+    literals = []
+    current = []
+
+    def flush():
+        if current:
+            literals.append("".join(current))
+            current.clear()
+
+    i = 0
+    while i < len(pattern):
+        c = pattern[i]
+        i += 1
+        if c == "\\":
+            escaped = pattern[i:i + 1]
+            i += 1
+            if escaped and not escaped.isalnum() and not escaped.isspace():
+                current.append(escaped)
+            elif escaped.isdigit() or escaped in "xuUN":
+                # Escape sequence spanning several characters, give up
+                return []
+            else:
+                # Character class, anchor or backreference
+                flush()
+        elif c == "[":
+            # Skip the character set
+            if pattern[i:i + 1] == "^":
+                i += 1
+            if pattern[i:i + 1] == "]":
+                i += 1
+            while i < len(pattern) and pattern[i] != "]":
+                i += 2 if pattern[i] == "\\" else 1
+            i += 1
+            flush()
+        elif c in "*?{":
+            # Previous atom is optional
+            if current:
+                current.pop()
+            if c == "{":
+                end = pattern.find("}", i)
+                i = len(pattern) if end < 0 else end + 1
+            flush()
+        elif c == "+":
+            # Previous atom is required, but may repeat
+            flush()
+        elif c in ".^$":
+            flush()
+        else:
+            current.append(c)
+    flush()
+    return literals
+
+
+class TextIndex(object):
+    """
+    Trigram index over note bodies.
+
+    Narrows the candidate set for a (case insensitive) regex search to the
+    notes containing every trigram of the literals the regex requires.
+    The regex must still be run on the candidates.
+
+    Notes are indexed on the first search after they were added, so loading
+    the database doesn't pay for the index unless it is used. Notes are
+    numbered and each trigram has an array of the numbers of the notes
+    containing it. Removed notes are left in the arrays and skipped, until
+    there are enough of them to make compacting worthwhile.
+    Safe to use from several threads, searches update the index.
+    """
+
+    def __init__(self):
+        super(TextIndex, self).__init__()
+        self._lock = threading.Lock()
+        # Notes not indexed yet
+        self._pending = {}
+        self._postings = {}
+        # Note number -> key (None if removed), key -> note number
+        self._keys = []
+        self._numbers = {}
+        self._removed = 0
+        # Keys of notes that couldn't be read, see take_unreadable
+        self._unreadable = set()
+
+    def add(self, key, note):
+        with self._lock:
+            self._remove(key)
+            self._pending[key] = note
+
+    def remove(self, key):
+        with self._lock:
+            self._remove(key)
+
+    def _remove(self, key):
+        self._pending.pop(key, None)
+        number = self._numbers.pop(key, None)
+        if number is not None:
+            self._keys[number] = None
+            self._removed += 1
+
+    def _update(self):
+        # Notes are taken off _pending one by one, so a failure leaves the
+        # index consistent. Notes that can't be read (lazy body, file removed
+        # or broken since) are left out until they are added again.
+        postings = self._postings
+        while self._pending:
+            key = next(iter(self._pending))
+            note = self._pending.pop(key)
+            try:
+                grams = trigrams(note.body)
+            except (OSError, MalformedNote):
+                self._unreadable.add(key)
+                continue
+            number = len(self._keys)
+            self._keys.append(key)
+            self._numbers[key] = number
+            for gram in grams:
+                notes = postings.get(gram)
+                if notes is None:
+                    notes = postings[gram] = array("I")
+                notes.append(number)
+        if self._removed > max(COMPACT_MIN, len(self._numbers)):
+            self._compact()
+
+    def take_unreadable(self):
+        # Keys of notes left out since the last call
+        with self._lock:
+            keys, self._unreadable = self._unreadable, set()
+        return keys
+
+    def _compact(self):
+        # Renumber the remaining notes, dropping removed ones from the postings
+        renumber = [-1] * len(self._keys)
+        keys = [k for k in self._keys if k is not None]
+        for number, key in enumerate(keys):
+            renumber[self._numbers[key]] = number
+            self._numbers[key] = number
+        for gram, notes in list(self._postings.items()):
+            notes = array("I", [renumber[n] for n in notes if renumber[n] >= 0])
+            if notes:
+                self._postings[gram] = notes
+            else:
+                del self._postings[gram]
+        self._keys = keys
+        self._removed = 0
+
+    def candidates(self, pattern):
+        # Returns a set of keys or None if the pattern can't be narrowed
+        grams = set()
+        for literal in required_literals(pattern):
+            grams |= trigrams(literal)
+        if not grams:
+            return None
+        with self._lock:
+            self._update()
+            postings = sorted((self._postings.get(gram, ()) for gram in grams), key=len)
+            numbers = set(postings[0])
+            for notes in postings[1:]:
+                if not numbers:
+                    break
+                numbers.intersection_update(notes)
+            keys = self._keys
+            return {keys[n] for n in numbers if keys[n] is not None}
+
+
+class SortIndex(object):
+    """
+    Notes ordered by one field, as a sorted list of (value, key).
+
+    Ties are broken by key, so walking the index gives the same order as
+    sorting with sort_key().
+    """
+
+    def __init__(self, getter):
+        super(SortIndex, self).__init__()
+        self.getter = getter
+        self._values = {}
+        self._sorted = None
+
+    def add(self, key, note):
+        value = self.getter(note)
+        self._values[key] = value
+        if self._sorted is not None:
+            bisect.insort(self._sorted, (value, key))
+
+    def remove(self, key):
+        value = self._values.pop(key, None)
+        if self._sorted is not None and value is not None:
+            del self._sorted[bisect.bisect_left(self._sorted, (value, key))]
+
+    def sort_key(self, key):
+        return (self._values[key], key)
+
+    def _entries(self):
+        if self._sorted is None:
+            self._sorted = sorted((v, k) for k, v in self._values.items())
+        return self._sorted
+
+    def ordered(self, keys, reverse=False):
+        # Generate keys (a subset of the indexed keys) in index order
+        entries = reversed(self._entries()) if reverse else self._entries()
+        return (k for (_, k) in entries if k in keys)
+
+    def range(self, start=None, end=None):
+        # Keys with start <= value < end, None meaning unbounded
+        entries = self._entries()
+        lo = 0 if start is None else bisect.bisect_left(entries, (start,))
+        hi = len(entries) if end is None else bisect.bisect_left(entries, (end,), lo)
+        return {k for (_, k) in entries[lo:hi]}
+
+
+class LinkGraph(object):
+    """
+    Links between notes, as forward and reverse adjacency sets keyed by ID.
+
+    Targets of links are recorded whether or not a note with that ID
+    exists, so links to a note show up as soon as it is created.
+    """
+
+    def __init__(self):
+        super(LinkGraph, self).__init__()
+        self._forward = {}
+        self._reverse = defaultdict(set)
+
+    def add(self, source, targets):
+        # Set the outgoing links of source, replacing any previous ones
+        self.remove(source)
+        targets = set(targets)
+        self._forward[source] = targets
+        for target in targets:
+            self._reverse[target].add(source)
+
+    def remove(self, source):
+        # Returns the removed outgoing links of source
+        targets = self._forward.pop(source, set())
+        for target in targets:
+            sources = self._reverse[target]
+            sources.discard(source)
+            if not sources:
+                del self._reverse[target]
+        return targets
+
+    def outgoing(self, node):
+        return self._forward.get(node, set())
+
+    def incoming(self, node):
+        return self._reverse.get(node, set())
+
+    def linked(self, nodes):
+        # Nodes linking to any of nodes
+        result = set()
+        for node in nodes:
+            result |= self.incoming(node)
+        return result
+
+    def linked_from(self, nodes):
+        # Nodes linked from any of nodes
+        result = set()
+        for node in nodes:
+            result |= self.outgoing(node)
+        return result
+
+    def orphans(self, nodes):
+        # Nodes (from the container nodes) neither linking to nor linked from another node in nodes
+        return {
+            n for n in nodes
+            if not self.incoming(n) and not any(t in nodes for t in self.outgoing(n))
+        }
+
+    def neighbourhood(self, node, hops=1, direction="both", nodes=None):
+        """
+        Nodes reachable from node in at most hops steps.
+
+        Args:
+            node (str): Start node.
+            hops (int): Max number of links to follow.
+            direction (str): Follow links "out", "in" or in "both" directions.
+            nodes (container, optional): Only visit these nodes, e.g. skip
+                targets of links to missing notes.
+
+        Returns:
+            dict: {node: distance}, including node itself at distance 0.
+        """
+        distance = {node: 0}
+        frontier = [node]
+        for hop in range(1, hops + 1):
+            reached = []
+            for n in frontier:
+                if direction in ("out", "both"):
+                    reached.extend(self.outgoing(n))
+                if direction in ("in", "both"):
+                    reached.extend(self.incoming(n))
+            frontier = []
+            for n in reached:
+                if n not in distance and (nodes is None or n in nodes):
+                    distance[n] = hop
+                    frontier.append(n)
+            if not frontier:
+                break
+        return distance
@@ -0,0 +1,70 @@
+import threading
+from collections import OrderedDict
+
+#
+# Memo of query results, see ZK.query_page
+#
+# Results are keyed by (query, sort field, reverse, generation), where the
+# generation is bumped by every change to the database, so entries never go
+# stale, they just stop being asked for and age out.
+#
+
+
+class QueryResult(object):
+    """
+    Paths matching a query, and the (start of) their ordering.
+
+    ordered is None or a tuple (paths in order, complete), where the list
+    holds all paths if complete and otherwise (at least) the first pages.
+    """
+
+    __slots__ = ("paths", "ordered")
+
+    def __init__(self, paths):
+        super(QueryResult, self).__init__()
+        self.paths = paths
+        self.ordered = None
+
+    def page(self, offset, end):
+        # The requested slice, or None if it hasn't been ordered yet
+        if self.ordered is None:
+            return None
+        (ordered, complete) = self.ordered
+        if not complete and (end is None or end > len(ordered)):
+            return None
+        return ordered[offset:end]
+
+
+class QueryMemo(object):
+    """LRU cache of QueryResults, safe to share between threads"""
+
+    def __init__(self, size):
+        super(QueryMemo, self).__init__()
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            result = self._entries.get(key)
+            if result is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return result
+
+    def put(self, key, result):
+        if self.size <= 0:
+            return
+        with self._lock:
+            self._entries[key] = result
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
@@ -0,0 +1,151 @@
+import time
+import bisect
+import threading
+from contextlib import contextmanager, nullcontext
+from collections import defaultdict
+
+from .config import conf
+
+#
+# Opt-in instrumentation (config: metrics = true)
+#
+# Stages of work (scanning the notes dir, evaluating a query, rendering
+# markdown, ...) are timed with
+#
+#     with metrics.timer("scan"):
+#         ...
+#
+# and events counted with metrics.count("cache_hits", n). Timings go into
+# per-stage histograms, exposed in Prometheus text format by render(), and
+# into the trace of the current request (if any, see start_trace), which the
+# server reports in a Server-Timing header.
+# When disabled, timer() and count() cost a function call and nothing else.
+#
+
+# Histogram bucket upper bounds, in seconds
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+enabled = conf["metrics"]
+
+_lock = threading.Lock()
+_histograms = {}
+_counters = defaultdict(int)
+_local = threading.local()
+_null = nullcontext()
+
+
+def enable(flag=True):
+    global enabled
+    enabled = flag
+
+
+def reset():
+    with _lock:
+        _histograms.clear()
+        _counters.clear()
+
+
+class Histogram(object):
+    """Counts of observed durations per bucket, plus their sum"""
+
+    def __init__(self):
+        super(Histogram, self).__init__()
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, seconds):
+        self.counts[bisect.bisect_left(BUCKETS, seconds)] += 1
+        self.sum += seconds
+        self.count += 1
+
+
+class Trace(object):
+    """Stage timings and counters collected while handling one request"""
+
+    def __init__(self):
+        super(Trace, self).__init__()
+        self.start = time.perf_counter()
+        self.timings = {}
+        self.counters = {}
+
+    def elapsed(self):
+        return time.perf_counter() - self.start
+
+    def add(self, stage, seconds):
+        (total, n) = self.timings.get(stage, (0.0, 0))
+        self.timings[stage] = (total + seconds, n + 1)
+
+    def server_timing(self):
+        # Value for the Server-Timing header, durations in ms
+        entries = [f'{stage};dur={total * 1000:.2f}' for stage, (total, _) in self.timings.items()]
+        entries.extend(f'{name};desc="{n}"' for name, n in self.counters.items())
+        entries.append(f'total;dur={self.elapsed() * 1000:.2f}')
+        return ", ".join(entries)
+
+
+def timer(stage):
+    # Context manager timing stage
+    return _timer(stage) if enabled else _null
+
+
+@contextmanager
+def _timer(stage):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(stage, time.perf_counter() - start)
+
+
+def observe(stage, seconds):
+    with _lock:
+        histogram = _histograms.get(stage)
+        if histogram is None:
+            histogram = _histograms[stage] = Histogram()
+        histogram.observe(seconds)
+    trace = getattr(_local, "trace", None)
+    if trace is not None:
+        trace.add(stage, seconds)
+
+
+def count(name, n=1):
+    if not enabled:
+        return
+    with _lock:
+        _counters[name] += n
+    trace = getattr(_local, "trace", None)
+    if trace is not None:
+        trace.counters[name] = trace.counters.get(name, 0) + n
+
+
+def start_trace():
+    # Collect timings of the current thread until end_trace()
+    _local.trace = Trace() if enabled else None
+
+
+def end_trace():
+    # Returns the Trace, or None if metrics are disabled
+    trace = getattr(_local, "trace", None)
+    _local.trace = None
+    return trace
+
+
+def render():
+    # All histograms and counters in Prometheus text format
+    lines = []
+    with _lock:
+        histograms = sorted(_histograms.items())
+        counters = sorted(_counters.items())
+        lines.append("# TYPE zk2_stage_seconds histogram")
+        for stage, histogram in histograms:
+            cumulative = 0
+            for bound, n in zip(BUCKETS + ("+Inf",), histogram.counts):
+                cumulative += n
+                lines.append(f'zk2_stage_seconds_bucket{{stage="{stage}",le="{bound}"}} {cumulative}')
+            lines.append(f'zk2_stage_seconds_sum{{stage="{stage}"}} {histogram.sum}')
+            lines.append(f'zk2_stage_seconds_count{{stage="{stage}"}} {histogram.count}')
+        for name, n in counters:
+            lines.append(f"# TYPE zk2_{name}_total counter")
+            lines.append(f"zk2_{name}_total {n}")
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,279 @@
+import re
+from datetime import datetime, timedelta
+from functools import lru_cache
+from collections import namedtuple
+
+from . import definitions as defs
+
+#
+# Query language
+#
+#   foo bar          notes tagged foo* and bar* (tags match partially, case insensitive)
+#   "regex           note text matching regex (case insensitive), up to a closing " or
+#                    (for compatibility) up to an @ or the end of the query
+#   @1408            notes with an ID starting with 1408
+#   untagged         notes without tags
+#   foo OR bar       either
+#   -foo, NOT foo    negation
+#   ( ... )          grouping
+#   field:value      tag:foo, id:1408, title:regex, author:regex, text:regex,
+#                    date:2014-08, modified:2019..2020-06, date:>=2021, date:<2014-08-15,
+#                    linksto:ID, linkedfrom:ID, is:orphan, is:untagged, is:archived
+#
+# NOT binds tighter than AND (juxtaposition), which binds tighter than OR.
+# Notes tagged archived are left out unless the query mentions archived.
+#
+# The old syntax, [tag]*["string with spaces]?[@123456789012]?, is a subset.
+# Malformed queries never raise, unmatched parentheses are ignored and
+# values that can't be parsed (dates) match nothing.
+#
+# Parsed queries and compiled regexes are cached, so re-running a query
+# (e.g. for each keystroke in the search bar) skips parsing entirely.
+#
+
+QUERY_CACHE_SIZE = 256
+REGEX_CACHE_SIZE = 256
+
+# AST, evaluated by ZK against its indexes
+All = namedtuple("All", [])
+Tag = namedtuple("Tag", ["prefix"])
+Id = namedtuple("Id", ["prefix"])
+Search = namedtuple("Search", ["field", "pattern"])
+Date = namedtuple("Date", ["field", "start", "end"])
+Link = namedtuple("Link", ["kind", "prefix"])
+Is = namedtuple("Is", ["what"])
+And = namedtuple("And", ["items"])
+Or = namedtuple("Or", ["items"])
+Not = namedtuple("Not", ["item"])
+
+NOTHING = Or(())
+
+SEARCH_FIELDS = {"text": defs.BODY, "body": defs.BODY, defs.TITLE: defs.TITLE, defs.AUTHOR: defs.AUTHOR}
+DATE_FIELDS = (defs.DATE, defs.MODIFIED)
+LINK_FIELDS = ("linksto", "linkedfrom")
+
+re_field = re.compile(r"([a-z]+):(.*)$", re.DOTALL)
+re_period = re.compile(r"(\d{4})(?:-(\d{1,2})(?:-(\d{1,2}))?)?$")
+
+# Token kinds
+OPEN, CLOSE, OR, NOT, TERM = "(", ")", "OR", "NOT", "term"
+
+
+@lru_cache(maxsize=REGEX_CACHE_SIZE)
+def search_regex(pattern):
+    # Case insensitive regex, pattern is taken literally if it isn't a valid regex
+    try:
+        return re.compile(pattern, re.IGNORECASE)
+    except re.error:
+        return re.compile(re.escape(pattern), re.IGNORECASE)
+
+
+@lru_cache(maxsize=QUERY_CACHE_SIZE)
+def parse_query(query_string):
+    """
+    Parse a query string into an AST (nested namedtuples, see above).
+
+    Args:
+        query_string (str): Query in the query language.
+
+    Returns:
+        tuple: Root node of the AST.
+    """
+    parser = _Parser(tokenize(query_string))
+    node = parser.expression()
+    while parser.peek() is not None:
+        # Stray closing parenthesis, carry on after it
+        parser.next()
+        node = _and([node, parser.expression()])
+    if not mentions_archived(node):
+        node = _and([Not(Is(defs.ARCHIVED)), node])
+    return node
+
+
+def mentions_archived(node):
+    if isinstance(node, Tag):
+        return node.prefix == defs.ARCHIVED
+    if isinstance(node, Is):
+        return node.what == defs.ARCHIVED
+    if isinstance(node, (And, Or)):
+        return any(mentions_archived(n) for n in node.items)
+    if isinstance(node, Not):
+        return mentions_archived(node.item)
+    return False
+
+
+def tokenize(text):
+    # Returns a list of (kind, node) with node set for TERM tokens only
+    tokens = []
+    i = 0
+    while i < len(text):
+        c = text[i]
+        if c.isspace():
+            i += 1
+        elif c in "()":
+            tokens.append((c, None))
+            i += 1
+        elif c == "-" and i + 1 < len(text) and not text[i + 1].isspace():
+            tokens.append((NOT, None))
+            i += 1
+        elif c == '"':
+            (pattern, i) = _quoted(text, i, compat=True)
+            if pattern:
+                tokens.append((TERM, Search(defs.BODY, pattern)))
+        elif c == "@":
+            j = _word_end(text, i + 1)
+            tokens.append((TERM, Id(text[i + 1:j])))
+            i = j
+        else:
+            j = _word_end(text, i)
+            word = text[i:j]
+            i = j
+            if word in (OR, NOT):
+                tokens.append((word, None))
+                continue
+            if word == "AND":
+                continue
+            if word.endswith(":") and text[i:i + 1] == '"':
+                (value, i) = _quoted(text, i)
+                word += value
+            tokens.append((TERM, _term(word)))
+    return tokens
+
+
+def _word_end(text, i):
+    while i < len(text) and not text[i].isspace() and text[i] not in '()"':
+        i += 1
+    return i
+
+
+def _quoted(text, i, compat=False):
+    # Returns (string, end index) for the string starting with a " at i.
+    # The old syntax has no closing quote, the search string runs to the next @.
+    end = text.find('"', i + 1)
+    if end >= 0:
+        return (text[i + 1:end].strip(" "), end + 1)
+    end = text.find("@", i + 1) if compat else -1
+    if end < 0:
+        end = len(text)
+    return (text[i + 1:end].strip(" "), end)
+
+
+def _term(word):
+    if word == "untagged":
+        return Is("untagged")
+    m = re_field.match(word)
+    if not m:
+        return Tag(word)
+    (field, value) = m.groups()
+    if field == "tag":
+        return Tag(value)
+    if field == "id":
+        return Id(value)
+    if field == "is":
+        return Is(value)
+    if field in LINK_FIELDS:
+        return Link(field, value)
+    if field in SEARCH_FIELDS:
+        return Search(SEARCH_FIELDS[field], value) if value else All()
+    if field in DATE_FIELDS:
+        try:
+            (start, end) = _date_range(value)
+        except ValueError:
+            return NOTHING
+        return Date(field, start, end)
+    # Not a known field, tags may contain ':'
+    return Tag(word)
+
+
+def _period(text):
+    # (first instant, first instant after) of a year, month or day
+    m = re_period.match(text)
+    if not m:
+        raise ValueError(f"Bad date: {text}")
+    (year, month, day) = (int(g) if g else None for g in m.groups())
+    if month is None:
+        return (datetime(year, 1, 1), datetime(year + 1, 1, 1))
+    if day is None:
+        start = datetime(year, month, 1)
+        end = datetime(year + 1, 1, 1) if month == 12 else datetime(year, month + 1, 1)
+        return (start, end)
+    start = datetime(year, month, day)
+    return (start, start + timedelta(days=1))
+
+
+def _date_range(value):
+    # (start, end) for start <= date < end, None meaning unbounded
+    if ".." in value:
+        (first, last) = value.split("..", 1)
+        return (_period(first)[0] if first else None, _period(last)[1] if last else None)
+    if value.startswith(">="):
+        return (_period(value[2:])[0], None)
+    if value.startswith(">"):
+        return (_period(value[1:])[1], None)
+    if value.startswith("<="):
+        return (None, _period(value[2:])[1])
+    if value.startswith("<"):
+        return (None, _period(value[1:])[0])
+    return _period(value)
+
+
+def _and(items):
+    items = [n for n in items if not isinstance(n, All)]
+    if not items:
+        return All()
+    return items[0] if len(items) == 1 else And(tuple(items))
+
+
+class _Parser(object):
+    """Recursive descent over the token list"""
+
+    def __init__(self, tokens):
+        super(_Parser, self).__init__()
+        self.tokens = tokens
+        self.pos = 0
+
+    def peek(self):
+        return self.tokens[self.pos][0] if self.pos < len(self.tokens) else None
+
+    def next(self):
+        token = self.tokens[self.pos]
+        self.pos += 1
+        return token
+
+    def expression(self):
+        # term (OR term)*
+        items = [self.conjunction()]
+        while self.peek() == OR:
+            self.next()
+            items.append(self.conjunction())
+        items = [n for n in items if n is not None]
+        if not items:
+            return All()
+        if any(isinstance(n, All) for n in items):
+            return All()
+        return items[0] if len(items) == 1 else Or(tuple(items))
+
+    def conjunction(self):
+        # Returns None if empty (e.g. "foo OR")
+        items = []
+        while self.peek() not in (None, OR, CLOSE):
+            node = self.unary()
+            if node is not None:
+                items.append(node)
+        return _and(items) if items else None
+
+    def unary(self):
+        kind = self.peek()
+        if kind == NOT:
+            self.next()
+            if self.peek() in (None, OR, CLOSE):
+                return None
+            node = self.unary()
+            return None if node is None else Not(node)
+        if kind == OPEN:
+            self.next()
+            node = self.expression()
+            if self.peek() == CLOSE:
+                self.next()
+            return node
+        return self.next()[1]
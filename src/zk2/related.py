@@ -0,0 +1,200 @@
+import re
+import math
+import heapq
+import threading
+from collections import Counter
+
+try:
+    import numpy
+    from scipy import sparse
+except ImportError:
+    numpy = None
+
+#
+# Related notes, see ZK.related
+#
+# Notes (title and body) are represented as TF-IDF vectors, with sublinear
+# term frequencies (1 + log tf) and smoothed IDF, normalised to unit length.
+# Notes are related by the cosine similarity of their vectors.
+#
+# Notes are tokenized when first needed, after that only added or changed
+# notes are. The weighted vectors depend on the IDF of every term, they are
+# rebuilt (from the cached term frequencies) on the first lookup after a
+# change. With NumPy and SciPy installed the vectors are the rows of a
+# sparse matrix and a lookup is a single matrix-vector product, otherwise
+# scores are summed over an inverted index.
+#
+
+# Title words count as this many occurrences
+TITLE_WEIGHT = 2
+
+re_word = re.compile(r"[^\W\d_]{3,}")
+re_url = re.compile(r"\w+://\S+")
+
+STOPWORDS = frozenset("""
+    about above after again against all also and any are because been before being below between
+    both but can could did does doing down during each few for from further had has have having her
+    here hers him his how into its itself just more most not now off once only other our out over
+    own same she should some such than that the their them then there these they this those through
+    too under until very was were what when where which while who whom why will with would you your
+""".split())
+
+
+def terms(text):
+    # {term: 1 + log(count)} for the words in text
+    counts = Counter(w for w in re_word.findall(re_url.sub(" ", text.lower())) if w not in STOPWORDS)
+    return {t: 1.0 + math.log(n) for t, n in counts.items()}
+
+
+def note_terms(note):
+    try:
+        body = note.body
+    except OSError:
+        # Lazy body, file removed since
+        body = ""
+    return terms(" ".join([note.title] * TITLE_WEIGHT + [body]))
+
+
+class RelatedIndex(object):
+    """
+    TF-IDF vectors of notes, for finding the notes most similar to a note or a text.
+
+    Safe to use from several threads, lookups update the index.
+    """
+
+    def __init__(self):
+        super(RelatedIndex, self).__init__()
+        self._lock = threading.Lock()
+        # Notes not tokenized yet
+        self._pending = {}
+        self._terms = {}
+        self._df = Counter()
+        # Derived from the above, None when stale
+        self._vectors = None
+
+    def add(self, key, note):
+        with self._lock:
+            self._remove(key)
+            self._pending[key] = note
+
+    def remove(self, key):
+        with self._lock:
+            self._remove(key)
+
+    def _remove(self, key):
+        self._pending.pop(key, None)
+        weights = self._terms.pop(key, None)
+        if weights is not None:
+            for t in weights:
+                self._df[t] -= 1
+                if not self._df[t]:
+                    del self._df[t]
+            self._vectors = None
+
+    def _update(self):
+        if self._pending:
+            for key, note in self._pending.items():
+                weights = note_terms(note)
+                self._terms[key] = weights
+                self._df.update(weights.keys())
+            self._pending = {}
+            self._vectors = None
+        if self._vectors is None:
+            self._vectors = _Matrix(self._terms, self._df) if numpy else _Postings(self._terms, self._df)
+        return self._vectors
+
+    def similar(self, key=None, text=None, k=10, exclude=()):
+        """
+        Find the notes most similar to a note or a text.
+
+        Args:
+            key: The note to find related notes for (not included in the result).
+            text (str): Text to find related notes for, if no key is given.
+            k (int): Max number of notes to return.
+            exclude (set): Keys of notes to leave out.
+
+        Returns:
+            list: (key, similarity) tuples, most similar first.
+        """
+        with self._lock:
+            vectors = self._update()
+            if key is not None:
+                query = self._terms.get(key)
+                if query is None:
+                    return []
+                exclude = set(exclude) | {key}
+            else:
+                query = terms(text or "")
+            return vectors.top(query, k, exclude)
+
+
+def _idf(df, n):
+    # Smoothed, never zero
+    return math.log((1 + n) / (1 + df)) + 1.0
+
+
+class _Postings(object):
+    """Pure Python vectors, scored term by term through an inverted index"""
+
+    def __init__(self, note_terms, df):
+        super(_Postings, self).__init__()
+        n = len(note_terms)
+        self.idf = {t: _idf(c, n) for t, c in df.items()}
+        self.postings = {}
+        for key, weights in note_terms.items():
+            norm = math.sqrt(sum((w * self.idf[t]) ** 2 for t, w in weights.items())) or 1.0
+            for t, w in weights.items():
+                self.postings.setdefault(t, []).append((key, w * self.idf[t] / norm))
+
+    def top(self, query, k, exclude):
+        query = {t: w * self.idf[t] for t, w in query.items() if t in self.idf}
+        norm = math.sqrt(sum(w * w for w in query.values())) or 1.0
+        scores = Counter()
+        for t, w in query.items():
+            for key, dw in self.postings[t]:
+                scores[key] += w * dw
+        hits = ((key, score / norm) for key, score in scores.items() if key not in exclude)
+        return heapq.nlargest(k, hits, key=lambda hit: hit[1])
+
+
+class _Matrix(object):
+    """Vectors as the rows of a sparse matrix"""
+
+    def __init__(self, note_terms, df):
+        super(_Matrix, self).__init__()
+        self.keys = list(note_terms)
+        self.rows = {key: i for i, key in enumerate(self.keys)}
+        self.columns = {t: j for j, t in enumerate(df)}
+        counts = numpy.fromiter((df[t] for t in self.columns), dtype=float, count=len(self.columns))
+        self.idf = numpy.log((1 + len(self.keys)) / (1 + counts)) + 1.0
+        columns = self.columns
+        indptr = numpy.zeros(len(self.keys) + 1, dtype=numpy.int64)
+        indptr[1:] = numpy.cumsum([len(note_terms[key]) for key in self.keys])
+        indices = numpy.fromiter(
+            (columns[t] for key in self.keys for t in note_terms[key]), dtype=numpy.int64, count=indptr[-1]
+        )
+        data = numpy.fromiter(
+            (w for key in self.keys for w in note_terms[key].values()), dtype=float, count=indptr[-1]
+        )
+        matrix = sparse.csr_matrix((data * self.idf[indices], indices, indptr),
+                                   shape=(len(self.keys), len(self.columns)))
+        norms = numpy.sqrt(numpy.asarray(matrix.multiply(matrix).sum(axis=1)).ravel())
+        norms[norms == 0] = 1.0
+        self.matrix = sparse.diags(1.0 / norms) @ matrix
+
+    def top(self, query, k, exclude):
+        vector = numpy.zeros(len(self.columns))
+        for t, w in query.items():
+            j = self.columns.get(t)
+            if j is not None:
+                vector[j] = w * self.idf[j]
+        norm = numpy.linalg.norm(vector)
+        if k <= 0 or not norm:
+            return []
+        scores = self.matrix @ (vector / norm)
+        excluded = [self.rows[key] for key in exclude if key in self.rows]
+        scores[excluded] = 0.0
+        k = min(k, len(scores))
+        best = numpy.argpartition(-scores, k - 1)[:k]
+        best = best[numpy.argsort(-scores[best], kind="stable")]
+        return [(self.keys[i], float(scores[i])) for i in best if scores[i] > 0]
@@ -0,0 +1,90 @@
+import threading
+import functools
+from contextlib import contextmanager
+
+
+class RWLock(object):
+    """
+    Readers-writer lock.
+
+    Any number of threads may read at the same time, a writer has exclusive
+    access. Waiting writers block new readers so that writers don't starve.
+    Both modes are reentrant, and the thread holding the write lock may also
+    read. Upgrading from read to write is not possible and raises RuntimeError.
+    """
+
+    def __init__(self):
+        super(RWLock, self).__init__()
+        self._cond = threading.Condition(threading.Lock())
+        self._readers = 0
+        self._writer = None
+        self._writes = 0
+        self._waiting_writers = 0
+        self._local = threading.local()
+
+    def _read_depth(self):
+        return getattr(self._local, "reads", 0)
+
+    def reading(self):
+        # True if the current thread holds the lock for reading (only)
+        return self._read_depth() > 0 and self._writer != threading.get_ident()
+
+    @contextmanager
+    def read(self):
+        me = threading.get_ident()
+        depth = self._read_depth()
+        if depth == 0 and self._writer != me:
+            with self._cond:
+                while self._writer is not None or self._waiting_writers:
+                    self._cond.wait()
+                self._readers += 1
+        self._local.reads = depth + 1
+        try:
+            yield
+        finally:
+            self._local.reads = depth
+            if depth == 0 and self._writer != me:
+                with self._cond:
+                    self._readers -= 1
+                    if self._readers == 0:
+                        self._cond.notify_all()
+
+    @contextmanager
+    def write(self):
+        me = threading.get_ident()
+        with self._cond:
+            if self._writer != me:
+                if self._read_depth():
+                    raise RuntimeError("Can't upgrade a read lock to a write lock")
+                self._waiting_writers += 1
+                while self._writer is not None or self._readers:
+                    self._cond.wait()
+                self._waiting_writers -= 1
+                self._writer = me
+            self._writes += 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._writes -= 1
+                if self._writes == 0:
+                    self._writer = None
+                    self._cond.notify_all()
+
+
+def reader(method):
+    # Run method holding the instance's _lock for reading
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self._lock.read():
+            return method(self, *args, **kwargs)
+    return wrapper
+
+
+def writer(method):
+    # Run method holding the instance's _lock for writing
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self._lock.write():
+            return method(self, *args, **kwargs)
+    return wrapper
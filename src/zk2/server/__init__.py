@@ -1,7 +1,11 @@
+import uuid
+import functools
+
 import flask
 import markupsafe
 
 import zk2
+from zk2 import metrics
 
 from . import mdproc
 
@@ -9,29 +13,77 @@ def create_app():
     app = flask.Flask(__name__, instance_relative_config=True)
 
     zk = zk2.ZK()
+    zk.subscribe(mdproc.cache.invalidate)
+    if zk2.config["watch"]:
+        zk.watch()
+
+    # ETags are <server instance>-<database generation>, so responses
+    # built from an unchanged database are answered with 304 Not Modified
+    instance = uuid.uuid4().hex[:8]
+
+    def conditional(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            # Apply pending changes first, they change the generation
+            zk.refresh()
+            etag = f"{instance}-{zk.generation}"
+            if flask.request.if_none_match.contains(etag):
+                response = flask.Response(status=304)
+            else:
+                response = flask.make_response(view(*args, **kwargs))
+            response.set_etag(etag)
+            # Cache, but always check with the server
+            response.headers['Cache-Control'] = 'no-cache'
+            return response
+        return wrapper
+
+    def render_template(template, **context):
+        with metrics.timer("template"):
+            return flask.render_template(template, **context)
+
+    if metrics.enabled:
+        @app.before_request
+        def start_trace():
+            metrics.start_trace()
+
+        @app.after_request
+        def end_trace(response):
+            trace = metrics.end_trace()
+            if trace is not None:
+                metrics.observe(f"request.{flask.request.endpoint}", trace.elapsed())
+                response.headers['Server-Timing'] = trace.server_timing()
+            return response
+
+        @app.route("/metrics")
+        def show_metrics():
+            return (metrics.render(), 200, {'Content-Type': 'text/plain; version=0.0.4'})
 
     @app.route("/")
     def index():
         val = flask.request.args.get('filter_value', '')
-        zk.rebuild_db()
-        return flask.render_template("index.html", filter_value=val)
+        # The watcher keeps the db up to date, otherwise rescan the notes dir
+        zk.refresh() if zk.watching else zk.rebuild_db()
+        return render_template("index.html", filter_value=val)
 
     @app.route("/tags")
+    @conditional
     def tags():
         tags = zk.tags(mincount=6, sort=True)
-        return flask.render_template("tags.html", tags=tags)
+        return render_template("tags.html", tags=tags)
 
     def _render(note_id, template):
         note = zk.note(note_id)
-        content = markupsafe.Markup(mdproc.render(note['body']))
+        content = markupsafe.Markup(mdproc.render(note['body'], note_id=note['id']))
         # content = markupsafe.Markup("<pre>Foo</pre>")
-        return flask.render_template(template, note=note, body=content)
+        return render_template(template, note=note, body=content)
 
     @app.route("/note/<note_id>")
+    @conditional
     def note(note_id):
         return _render(note_id, "note.html")
 
     @app.route("/peek/<note_id>")
+    @conditional
     def peek(note_id):
         return _render(note_id, "peek.html")
 
@@ -53,11 +105,27 @@ def create_app():
 
     @app.route("/query/")
     @app.route("/query/<query_string>")
+    @conditional
     def query(query_string=''):
         key = flask.request.args.get('key', 'date')
         rev = flask.request.args.get('reversed', 'true') == 'true'
-        notes = zk.query(query_string, sort_key=key, reverse=rev)
-        return flask.render_template("item.html", notes=notes)
+        offset = flask.request.args.get('offset', 0, type=int)
+        limit = flask.request.args.get('limit', None, type=int)
+        total, notes = zk.query_page(query_string, sort_key=key, reverse=rev, offset=max(0, offset),
+                                    limit=None if limit is None else max(0, limit))
+        response = flask.make_response(render_template("item.html", notes=notes))
+        response.headers['X-Total-Count'] = str(total)
+        return response
+
+    @app.route("/related/")
+    @app.route("/related/<note_id>")
+    @conditional
+    def related(note_id=None):
+        # Notes related to note_id, or to the text given as ?text=...
+        text = flask.request.args.get('text', '')
+        limit = flask.request.args.get('limit', 10, type=int)
+        notes = zk.related(note_id, text, k=max(0, limit))
+        return render_template("item.html", notes=notes)
 
     @app.route("/img/<path:name>")
     def img(name):
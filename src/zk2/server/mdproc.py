@@ -1,32 +1,256 @@
+import os
+import time
+import select
 import subprocess
 import shlex
+import hashlib
+import threading
+import queue
+import atexit
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from .. import metrics
+from .mdworker import load_function
 
 # Process markdown content using the `md_cmd` from `config.py`
 # Fallback to wrapping in <pre> ... </pre> environment if unavailable
+#
+# md_cmd variants:
+#   "/path/to/cmd args"       run cmd once per render, markdown on stdin, HTML on stdout
+#   "python:module[:func]"    render in-process with module.func (default func: markdown)
+#   "pool:/path/to/cmd args"  keep md_workers long-lived cmd processes speaking the
+#                             framed protocol of mdworker.py, e.g.
+#                             "pool:/usr/bin/python3 -m zk2.server.mdworker markdown"
 
 try:
     from ..config import conf
     md_cmd = conf["md_cmd"]
+    md_workers = conf["md_workers"]
+    md_timeout = conf["md_timeout"]
+    render_cache_size = conf["render_cache_size"]
 except:
     md_cmd = ''
+    md_workers = 2
+    md_timeout = 10
+    render_cache_size = 16 * 1024 * 1024
+
+_renderer = None
+_renderer_lock = threading.Lock()
+
+
+def renderer():
+    # Shared renderer for md_cmd, created on first use
+    global _renderer
+    with _renderer_lock:
+        if _renderer is None:
+            _renderer = make_renderer(md_cmd)
+        return _renderer
+
+
+def make_renderer(cmd):
+    cmd = cmd.strip()
+    if cmd.startswith("python:"):
+        return PythonRenderer(cmd[len("python:"):])
+    if cmd.startswith("pool:"):
+        return PoolRenderer(cmd[len("pool:"):], md_workers, md_timeout)
+    return Renderer(cmd)
+
+
+def render(text, note_id=None):
+    # Pass note_id to use the render cache
+    if note_id is not None:
+        key = (note_id, hashlib.blake2b(text.encode('utf8'), digest_size=16).digest())
+        html = cache.get(key)
+        if html is None:
+            metrics.count("render_cache_misses")
+            with metrics.timer("render"):
+                html = renderer().process(text)
+            cache.put(key, html)
+        else:
+            metrics.count("render_cache_hits")
+        return html
+    with metrics.timer("render"):
+        return renderer().process(text)
+
+
+def render_many(notes):
+    # Bulk (pre-)rendering of (note_id, text) pairs into the render cache
+    notes = list(notes)
+    with ThreadPoolExecutor(max_workers=max(1, md_workers)) as pool:
+        return list(pool.map(lambda n: render(n[1], note_id=n[0]), notes))
+
+
+class RenderCache(object):
+    """
+    LRU cache of rendered HTML keyed by (note_id, content hash),
+    bounded by the total size of the cached HTML.
+    """
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            html = self._entries.get(key)
+            if html is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return html
+
+    def put(self, key, html):
+        if len(html) > self.max_size:
+            return
+        with self._lock:
+            self._discard(key)
+            self._entries[key] = html
+            self.size += len(html)
+            while self.size > self.max_size:
+                _, old = self._entries.popitem(last=False)
+                self.size -= len(old)
+
+    def _discard(self, key):
+        html = self._entries.pop(key, None)
+        if html is not None:
+            self.size -= len(html)
+
+    def invalidate(self, note_ids):
+        # Drop all cached renderings of the given notes
+        note_ids = set(note_ids)
+        with self._lock:
+            for key in [k for k in self._entries if k[0] in note_ids]:
+                self._discard(key)
 
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
 
-def render(text):
-    r = Renderer()
-    return r.process(text)
+    def stats(self):
+        return {
+            "entries": len(self._entries),
+            "size": self.size,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+
+cache = RenderCache(render_cache_size)
 
 
 class Renderer(object):
-    """docstring for Renderer"""
-    def __init__(self):
-        self.cmd = shlex.split(md_cmd.strip())
+    """Render by running md_cmd once per document"""
+    def __init__(self, cmd=None):
+        self.cmd = shlex.split((md_cmd if cmd is None else cmd).strip())
 
     def process(self, text):
         return self._process(text) if self.cmd else self._default_process(text)
 
     def _process(self, text):
-        result = subprocess.run(self.cmd, input=text, capture_output=True, encoding='utf8')
+        try:
+            result = subprocess.run(self.cmd, input=text, capture_output=True, encoding='utf8')
+        except OSError:
+            return self._default_process(text)
         return result.stdout if result.returncode == 0 else self._default_process(text)
 
     def _default_process(self, text):
         return f'<pre class="default-pre">\n{text}\n</pre>'
+
+
+class PythonRenderer(Renderer):
+    """Render in-process using a Python markdown module, e.g. python:markdown"""
+    def __init__(self, spec):
+        super(PythonRenderer, self).__init__('')
+        self.cmd = spec.strip()
+        self._fn = None
+
+    def _process(self, text):
+        try:
+            if self._fn is None:
+                self._fn = load_function(self.cmd)
+            return self._fn(text)
+        except Exception:
+            return self._default_process(text)
+
+
+class PoolRenderer(Renderer):
+    """
+    Render using a pool of long-lived renderer processes.
+
+    Documents are sent on the worker's stdin as b"<length>\\n<utf8 data>" and
+    the HTML is read back from stdout in the same format, a length of -1
+    signals a failed render. Workers are started on demand and restarted
+    if they die. A worker that doesn't answer within timeout seconds is
+    killed, so that a hung renderer doesn't hold on to its slot.
+    """
+    def __init__(self, cmd, size, timeout=10):
+        super(PoolRenderer, self).__init__(cmd)
+        self.size = max(1, size)
+        self.timeout = timeout
+        self._slots = threading.Semaphore(self.size)
+        self._idle = queue.LifoQueue()
+        atexit.register(self.close)
+
+    def _spawn(self):
+        return subprocess.Popen(self.cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+
+    def _roundtrip(self, proc, text):
+        data = text.encode('utf8')
+        proc.stdin.write(b"%d\n" % len(data) + data)
+        proc.stdin.flush()
+        html = self._read_frame(proc.stdout.fileno(), time.monotonic() + self.timeout)
+        return None if html is None else html.decode('utf8')
+
+    def _read_frame(self, fd, deadline):
+        # Unbuffered reads from fd, so that select() sees all pending data
+        data = bytearray()
+        length = None
+        while True:
+            if length is None and b"\n" in data:
+                (header, _, rest) = bytes(data).partition(b"\n")
+                length = int(header)
+                if length < 0:
+                    return None
+                data = bytearray(rest)
+            if length is not None and len(data) >= length:
+                return bytes(data[:length])
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or not select.select([fd], [], [], remaining)[0]:
+                raise TimeoutError("Renderer process not responding")
+            chunk = os.read(fd, 64 * 1024)
+            if not chunk:
+                raise EOFError("Renderer process died")
+            data += chunk
+
+    def _process(self, text):
+        with self._slots:
+            try:
+                proc = self._idle.get_nowait()
+            except queue.Empty:
+                proc = None
+            try:
+                if proc is None or proc.poll() is not None:
+                    proc = self._spawn()
+                html = self._roundtrip(proc, text)
+            except (OSError, ValueError, EOFError):
+                if proc is not None:
+                    proc.kill()
+                    proc.wait()
+                return self._default_process(text)
+            self._idle.put(proc)
+            return self._default_process(text) if html is None else html
+
+    def close(self):
+        while True:
+            try:
+                proc = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            proc.stdin.close()
+            proc.wait()
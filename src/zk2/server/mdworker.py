@@ -0,0 +1,41 @@
+#!/usr/bin/env python3
+
+# Long-lived markdown renderer for md_cmd = "pool:..." (see mdproc.py)
+# Usage: python3 -m zk2.server.mdworker [module[:func]]
+#   e.g. python3 -m zk2.server.mdworker markdown
+#        python3 -m zk2.server.mdworker mistune:html
+#
+# Reads b"<length>\n<utf8 markdown>" from stdin, writes b"<length>\n<utf8 html>"
+# to stdout, or b"-1\n" if rendering failed.
+
+import sys
+import importlib
+
+
+def load_function(spec):
+    (module, _, func) = spec.partition(':')
+    return getattr(importlib.import_module(module), func or 'markdown')
+
+
+def serve(fn, infile, outfile):
+    while True:
+        header = infile.readline()
+        if not header:
+            break
+        text = infile.read(int(header)).decode('utf8')
+        try:
+            html = fn(text).encode('utf8')
+        except Exception:
+            outfile.write(b"-1\n")
+        else:
+            outfile.write(b"%d\n" % len(html) + html)
+        outfile.flush()
+
+
+def app():
+    spec = sys.argv[1] if len(sys.argv) > 1 else 'markdown'
+    serve(load_function(spec), sys.stdin.buffer, sys.stdout.buffer)
+
+
+if __name__ == '__main__':
+    app()
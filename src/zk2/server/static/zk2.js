@@ -2,11 +2,20 @@
 // = API for webpage =
 // ======================
 
+// Notes are fetched PAGE_SIZE at a time, more are loaded when scrolling the list
+var PAGE_SIZE = 100;
+var list_state = {expr: "", loaded: 0, total: 0, loading: false};
+
 function reset() {
     filter();
     set_tags();
     add_tag_listener(document.getElementById('tag_box'), filter_by_tag);
     add_tag_listener(document.getElementById('list_box'), filter_by_tag);
+    document.getElementById('list_box').addEventListener('scroll', function() {
+        if (this.scrollTop + this.clientHeight >= this.scrollHeight - 200) {
+            load_more();
+        }
+    });
     document.getElementById('search').focus();
 }
 
@@ -32,7 +41,29 @@ function drag(event) {
 // = Core functionality =
 // ======================
 function filter_notes(expr) {
-    get_request("query/"+expr+options(), update_list);
+    list_state = {expr: expr, loaded: 0, total: 0, loading: true};
+    get_request(query_url(expr, 0), function(data, xhr) {
+        if (expr == list_state.expr) {
+            update_list(data, xhr);
+        }
+    });
+}
+
+function load_more() {
+    if (list_state.loading || list_state.loaded >= list_state.total) {
+        return;
+    }
+    var expr = list_state.expr;
+    list_state.loading = true;
+    get_request(query_url(expr, list_state.loaded), function(data, xhr) {
+        if (expr == list_state.expr) {
+            append_list(data, xhr);
+        }
+    });
+}
+
+function query_url(expr, offset) {
+    return "query/"+expr+options()+"&offset="+offset+"&limit="+PAGE_SIZE;
 }
 
 function options() {
@@ -150,13 +181,26 @@ function peekOff(evt) {
 // =============
 // = Callbacks =
 // =============
-function update_list(data) {
+function update_list(data, xhr) {
     var list_box = document.getElementById("list_box");
     list_box.innerHTML = data;
+    update_list_state(list_box, xhr);
     show_top_note();
     // show_stats();
 }
 
+function append_list(data, xhr) {
+    var list_box = document.getElementById("list_box");
+    list_box.insertAdjacentHTML('beforeend', data);
+    update_list_state(list_box, xhr);
+}
+
+function update_list_state(list_box, xhr) {
+    list_state.loaded = list_box.children.length;
+    list_state.total = parseInt(xhr.getResponseHeader('X-Total-Count')) || list_state.loaded;
+    list_state.loading = false;
+}
+
 function update_tag_box(data) {
     document.getElementById("tag_box").innerHTML = data;
 }
@@ -182,7 +226,7 @@ function get_request(url, callback) {
     var xmlhttp = new XMLHttpRequest();
     xmlhttp.onreadystatechange = function() {
         if (this.readyState == 4 && this.status == 200) {
-            callback(this.responseText);
+            callback(this.responseText, this);
         }
     };
     xmlhttp.open("GET", url, true);
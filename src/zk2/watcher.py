@@ -0,0 +1,223 @@
+import os
+import sys
+import time
+import struct
+import select
+import threading
+import ctypes
+import ctypes.util
+
+from .ZKNote import is_shard
+from .config import conf
+
+# Watch a notes directory (and its yy/mm shards, see the layout setting)
+# and report changed note files to a ZK instance.
+# Uses inotify on Linux and falls back to polling the directory elsewhere.
+# Changes are not applied here, the paths are queued on the ZK instance and
+# picked up (incrementally) by its next refresh(). That keeps all updates
+# of the in-memory database on the request threads.
+# Polling rescans the whole tree, with no interval set the time between
+# scans grows with the time a scan takes (i.e. with the collection size).
+
+# inotify(7)
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+
+WATCH_MASK = (IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE
+              | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF)
+
+_event = struct.Struct("iIII")
+
+# Levels of shard directories (yy/mm) below the notes dir
+SHARD_DEPTH = 2
+
+# Automatic polling interval: at least MIN_INTERVAL seconds, and polling
+# spends no more than about 1/POLL_LOAD of the time scanning
+MIN_INTERVAL = 1.0
+POLL_LOAD = 20
+
+
+def is_note_file(filename):
+    # Skips temp and backup files written by editors, e.g. .zk1234.md.swp or zk1234.md~
+    (name, ext) = os.path.splitext(filename)
+    return ext == ".md" and name.startswith("zk")
+
+
+def is_shard_dir(entry):
+    # Subdirectories that may hold notes, see ZKNote.scan_note_files
+    return is_shard(entry.name) and entry.is_dir(follow_symlinks=False)
+
+
+class Watcher(object):
+    """
+    Background thread reporting changes to note files in zk.zkdir.
+
+    Bursts of events (editors writing temp files, renaming and touching the
+    note several times on save) are debounced, a batch of paths is reported
+    once no more events have arrived for `debounce` seconds.
+
+    `interval` is the time between directory scans when polling, 0 scales
+    it to the time a scan takes. Defaults to the watch_interval setting.
+    """
+
+    def __init__(self, zk, debounce=0.2, interval=None, use_inotify=True):
+        super(Watcher, self).__init__()
+        self.zk = zk
+        self.zkdir = zk.zkdir
+        self.debounce = debounce
+        self.interval = conf["watch_interval"] if interval is None else interval
+        self._scan_time = 0.0
+        self._stop = threading.Event()
+        self._thread = None
+        self._stats = None
+        self._libc = None
+        # {watch descriptor: (directory, depth below zkdir)}
+        self._dirs = {}
+        self._fd = self._inotify() if use_inotify else None
+
+    @property
+    def backend(self):
+        return "inotify" if self._fd is not None else "polling"
+
+    def _inotify(self):
+        if not sys.platform.startswith("linux"):
+            return None
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+            fd = libc.inotify_init1(os.O_CLOEXEC | os.O_NONBLOCK)
+            if fd < 0:
+                return None
+            self._libc = libc
+            if not self._watch_tree(fd, self.zkdir, 0):
+                os.close(fd)
+                return None
+        except (OSError, AttributeError):
+            return None
+        return fd
+
+    def _watch_tree(self, fd, path, depth):
+        # Watch path and its shards (yy/mm), False if path can't be watched
+        wd = self._libc.inotify_add_watch(fd, os.fsencode(path), WATCH_MASK)
+        if wd < 0:
+            return False
+        self._dirs[wd] = (path, depth)
+        if depth < SHARD_DEPTH:
+            try:
+                with os.scandir(path) as entries:
+                    subdirs = [e.path for e in entries if is_shard_dir(e)]
+            except OSError:
+                subdirs = []
+            for subdir in subdirs:
+                self._watch_tree(fd, subdir, depth + 1)
+        return True
+
+    def start(self):
+        if self._fd is None:
+            self._stats = self._scan()
+        run = self._run_inotify if self._fd is not None else self._run_polling
+        self._thread = threading.Thread(target=run, name="zk-watcher", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def _report(self, notepaths):
+        for notepath in notepaths:
+            self.zk._add_pending(notepath)
+
+    def _run_inotify(self):
+        changed = set()
+        deadline = None
+        while not self._stop.is_set():
+            timeout = (self.interval or MIN_INTERVAL) if deadline is None else max(0, deadline - time.monotonic())
+            ready, _, _ = select.select([self._fd], [], [], timeout)
+            if ready:
+                rescan = self._read_events(changed)
+                if rescan:
+                    # Lost events, let the ZK instance rescan the directory
+                    changed.clear()
+                    self.zk._add_pending(None)
+                    deadline = None
+                    continue
+                if changed:
+                    deadline = time.monotonic() + self.debounce
+            elif deadline is not None:
+                self._report(changed)
+                changed = set()
+                deadline = None
+
+    def _read_events(self, changed):
+        # Returns True if a rescan is needed
+        try:
+            data = os.read(self._fd, 64 * 1024)
+        except BlockingIOError:
+            return False
+        rescan = False
+        offset = 0
+        while offset < len(data):
+            (wd, mask, _, length) = _event.unpack_from(data, offset)
+            offset += _event.size
+            name = data[offset:offset + length].rstrip(b"\0")
+            offset += length
+            if mask & IN_IGNORED:
+                self._dirs.pop(wd, None)
+                continue
+            if mask & (IN_Q_OVERFLOW | IN_DELETE_SELF | IN_MOVE_SELF):
+                rescan = True
+                continue
+            if wd not in self._dirs:
+                continue
+            (dirpath, depth) = self._dirs[wd]
+            filename = os.fsdecode(name)
+            if mask & IN_ISDIR:
+                if depth >= SHARD_DEPTH or not is_shard(filename):
+                    continue
+                if mask & (IN_CREATE | IN_MOVED_TO):
+                    self._watch_tree(self._fd, os.path.join(dirpath, filename), depth + 1)
+                # Notes may have been added to (or moved with) the directory
+                # before it was watched
+                rescan = True
+            elif is_note_file(filename):
+                changed.add(os.path.join(dirpath, filename))
+        return rescan
+
+    def _scan(self):
+        start = time.monotonic()
+        stats = self.zk.scan_note_files(self.zkdir)
+        self._scan_time = time.monotonic() - start
+        return stats
+
+    def _poll_interval(self):
+        if self.interval:
+            return self.interval
+        return max(MIN_INTERVAL, POLL_LOAD * self._scan_time)
+
+    def _run_polling(self):
+        stats = self._stats
+        while not self._stop.wait(self._poll_interval()):
+            try:
+                current = self._scan()
+            except OSError:
+                continue
+            changed = {p for p, s in current.items() if stats.get(p) != s}
+            changed |= {p for p in stats if p not in current}
+            if changed:
+                # Wait for the burst to settle before reporting
+                self._stop.wait(self.debounce)
+                self._report(changed)
+            stats = current
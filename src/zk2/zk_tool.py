@@ -5,9 +5,12 @@
 import sys
 import os
 import argparse
+import subprocess
 import urllib.parse
 
 import zk2
+from zk2 import config
+from zk2.ZKNote import LAYOUTS
 
 def app():
 
@@ -30,30 +33,106 @@ def app():
     parser.add_argument('--dir', action="store_true",
                         help="Return path to directory of ZK notes as set in config")
 
+    parser.add_argument('--migrate', choices=LAYOUTS, metavar="LAYOUT",
+                        help="Move all notes into LAYOUT (flat: zk<ID>.md, sharded: yy/mm/zk<ID>.md)")
+
     args = parser.parse_args()
 
-    config = zk2.config
-    body = args.infile.read() if args.infile else None
-    db = zk2.ZK()
+    # Only what's needed is loaded, the full database (zk2.ZK) is a last resort
+    zkdir = os.path.expanduser(config["notesdir"])
 
     if args.dir:
-        print(os.path.expanduser(config.notesdir))
+        print(zkdir)
         sys.exit(0)
 
+    if args.migrate:
+        sys.exit(migrate(zkdir, args.migrate))
+
     if args.tags:
-        tags = db.tags(mincount=1)
-        print(" ".join(tags))
+        print(" ".join(current_tags(zkdir)))
         sys.exit(0)
 
+    body = args.infile.read() if args.infile else None
+
     try:
-        note_id = db.create(body)
+        notepath = create(zkdir, body)
     except Exception as err:
         sys.stderr.write(str(err)+'\n\n')
         sys.stderr.write('Error: Could not create zk-note\n')
         sys.exit(1)
 
     if args.edit:
-        db.edit(note_id)
+        subprocess.run(f'{config["editor"]} "{notepath}"', shell=True)
+        cache_note(zkdir, notepath)
+
+
+def migrate(zkdir, layout):
+    # Returns the exit status
+    from zk2.ZKNote import scan_note_files, note_path
+    moves = []
+    failed = 0
+    for notepath in sorted(scan_note_files(zkdir)):
+        note_id = os.path.splitext(os.path.basename(notepath))[0][len("zk"):]
+        target = note_path(zkdir, note_id, layout)
+        if target == notepath:
+            continue
+        if os.path.exists(target):
+            sys.stderr.write(f"Error: Not moving {notepath}, {target} exists\n")
+            failed += 1
+            continue
+        try:
+            # Creates the new shard dirs and removes emptied ones
+            os.renames(notepath, target)
+        except OSError as err:
+            sys.stderr.write(f"Error: Could not move {notepath}: {err}\n")
+            failed += 1
+            continue
+        moves.append((notepath, target))
+    if config["cache"]:
+        from zk2.cache import NoteCache
+        NoteCache(zkdir).move(moves)
+    print(f"Moved {len(moves)} notes to the {layout} layout")
+    if config["layout"] != layout:
+        print(f'Set layout = "{layout}" in ~/.zk_config for new notes to follow')
+    return 1 if failed else 0
+
+
+def current_tags(zkdir):
+    # From the cache if it's up to date, otherwise load (and re-cache) the notes
+    if config["cache"] and os.path.isdir(zkdir):
+        from zk2.ZKNote import scan_note_files
+        from zk2.cache import NoteCache
+        counts = NoteCache(zkdir).tag_counts(scan_note_files(zkdir))
+        if counts is not None:
+            return sorted(counts)
+    # Tags only, no need for a search index
+    return zk2.ZK(zkdir, search_index=False).tags(mincount=1)
+
+
+def create(zkdir, body):
+    # Returns the path of the new note
+    from zk2.ZKNote import scan_note_files
+    if not os.path.isdir(zkdir) or not scan_note_files(zkdir):
+        # Let ZK set up the notes directory (welcome note)
+        # Only note files count, see ZK._maybe_init_db
+        db = zk2.ZK(zkdir, search_index=False)
+        return db.filepath(db.create(body))
+    note = zk2.ZKNote()
+    note.body = body
+    note.write(zkdir)
+    notepath = note.filepath(zkdir)
+    cache_note(zkdir, notepath)
+    return notepath
+
+
+def cache_note(zkdir, notepath):
+    # Add the note to the cache, the next load won't have to parse it
+    if not config["cache"]:
+        return
+    from zk2.cache import NoteCache
+    st = os.stat(notepath)
+    note = zk2.ZKNote(notepath)
+    NoteCache(zkdir).store([(notepath, (st.st_mtime_ns, st.st_size), note, note.links())])
 
 
 if __name__ == '__main__':